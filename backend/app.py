@@ -1,28 +1,242 @@
-from flask import Flask, redirect, url_for, session, request, jsonify, send_from_directory
+from flask import Flask, Response, redirect, url_for, session, request, jsonify, send_from_directory, has_request_context
+from flask.json.provider import JSONProvider
 from authlib.integrations.flask_client import OAuth
 from authlib.common.security import generate_token
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne, DeleteOne, ReplaceOne, monitoring
 import os
+import io
+import csv
+import random
+import math
+import re
+import json
+import queue
+import time
+import atexit
+import threading
 import requests
-from bson import ObjectId
-from datetime import datetime, timezone
+from bson import ObjectId, Decimal128
+from datetime import datetime, timezone, timedelta
 from functools import wraps
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque, OrderedDict
 
-app = Flask(__name__, static_folder='../frontend/dist', static_url_path='')
+try:
+    import orjson
+except ImportError:  # fall back to the standard library encoder
+    orjson = None
+
+def json_default(value):
+    """Encode the BSON types our documents carry"""
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, datetime):
+        # pymongo returns naive datetimes that are in UTC
+        return (value if value.tzinfo else value.replace(tzinfo=timezone.utc)).isoformat()
+    if isinstance(value, Decimal128):
+        return str(value.to_decimal())
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+class MongoJSONProvider(JSONProvider):
+    """JSON provider that encodes ObjectId/datetime natively, using orjson when installed"""
+
+    def dumps(self, obj, **kwargs):
+        if orjson is not None:
+            return orjson.dumps(obj, default=json_default, option=orjson.OPT_NAIVE_UTC | orjson.OPT_NON_STR_KEYS).decode()
+        kwargs.setdefault('default', json_default)
+        return json.dumps(obj, **kwargs)
+
+    def loads(self, s, **kwargs):
+        if orjson is not None:
+            return orjson.loads(s)
+        return json.loads(s, **kwargs)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        if orjson is not None:
+            body = orjson.dumps(obj, default=json_default, option=orjson.OPT_NAIVE_UTC | orjson.OPT_NON_STR_KEYS)
+        else:
+            body = json.dumps(obj, default=json_default, separators=(',', ':'))
+        return self._app.response_class(body, mimetype='application/json')
+
+class MongoFlask(Flask):
+    json_provider_class = MongoJSONProvider
+
+app = MongoFlask(__name__, static_folder='../frontend/dist', static_url_path='')
 app.secret_key = os.urandom(24)
 
 DUMMYJSON_BASE_URL = "https://dummyjson.com"
 
+# Slow-query profiling through pymongo command monitoring
+SLOW_QUERY_MS = float(os.getenv('SLOW_QUERY_MS', 100))
+SLOW_QUERY_EXPLAIN_SAMPLE_RATE = float(os.getenv('SLOW_QUERY_EXPLAIN_SAMPLE_RATE', 0.1))
+SLOW_QUERY_MAX_SHAPES = 200
+PROFILED_COMMANDS = {'find', 'aggregate', 'count', 'distinct', 'update', 'delete', 'findAndModify'}
+EXPLAINABLE_COMMANDS = {'find', 'aggregate', 'count', 'distinct'}
+COMMAND_META_FIELDS = {'lsid', '$db', '$clusterTime', '$readPreference', 'txnNumber', 'cursor', 'batchSize'}
+
+def query_shape(value):
+    """Replace literal values with '?' so queries group by structure, not data"""
+    if isinstance(value, dict):
+        return {key: query_shape(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [query_shape(value[0])] if value and isinstance(value[0], (dict, list, tuple)) else "?"
+    return "?"
+
+def command_filter(command_name, command):
+    """The part of a command that decides which index is used"""
+    if command_name in ('find', 'count', 'distinct'):
+        return command.get('filter', command.get('query', {}))
+    if command_name == 'aggregate':
+        return command.get('pipeline', [])
+    if command_name == 'update':
+        return (command.get('updates') or [{}])[0].get('q', {})
+    if command_name == 'delete':
+        return (command.get('deletes') or [{}])[0].get('q', {})
+    if command_name == 'findAndModify':
+        return command.get('query', {})
+    return {}
+
+def plan_stages(plan):
+    """Every stage name in an explain plan tree"""
+    stages = []
+    if isinstance(plan, dict):
+        if 'stage' in plan:
+            stages.append(plan['stage'])
+        for value in plan.values():
+            stages.extend(plan_stages(value))
+    elif isinstance(plan, list):
+        for value in plan:
+            stages.extend(plan_stages(value))
+    return stages
+
+class QueryProfiler(monitoring.CommandListener):
+    """Record query shapes slower than a threshold, with the issuing route and sampled explain plans"""
+
+    def __init__(self, threshold_ms=SLOW_QUERY_MS, explain_sample_rate=SLOW_QUERY_EXPLAIN_SAMPLE_RATE,
+                 max_shapes=SLOW_QUERY_MAX_SHAPES):
+        self.threshold_ms = threshold_ms
+        self.explain_sample_rate = explain_sample_rate
+        self.max_shapes = max_shapes
+        self.database = None  # set once the client exists; used to run explain
+        self.lock = threading.Lock()
+        self.in_flight = {}   # request_id -> (shape key, route, command)
+        self.shapes = {}
+        self.explain_queue = queue.Queue(maxsize=100)
+        self.explainer = None
+
+    def started(self, event):
+        if event.command_name not in PROFILED_COMMANDS:
+            return
+        collection = event.command.get(event.command_name)
+        shape = query_shape(command_filter(event.command_name, event.command))
+        key = (collection, event.command_name, json.dumps(shape, sort_keys=True))
+        route = request.endpoint if has_request_context() else None
+        with self.lock:
+            self.in_flight[event.request_id] = (key, route, event.command)
+
+    def succeeded(self, event):
+        self.finished(event)
+
+    def failed(self, event):
+        self.finished(event)
+
+    def finished(self, event):
+        with self.lock:
+            started = self.in_flight.pop(event.request_id, None)
+        if started is None:
+            return
+        duration_ms = event.duration_micros / 1000
+        if duration_ms >= self.threshold_ms:
+            self.record(*started, duration_ms)
+
+    def record(self, key, route, command, duration_ms):
+        with self.lock:
+            stats = self.shapes.get(key)
+            if stats is None:
+                if len(self.shapes) >= self.max_shapes:
+                    return
+                stats = self.shapes[key] = {
+                    "collection": key[0], "command": key[1], "shape": json.loads(key[2]),
+                    "count": 0, "total_ms": 0.0, "max_ms": 0.0, "routes": {}, "plan": None, "collscan": None
+                }
+            stats["count"] += 1
+            stats["total_ms"] += duration_ms
+            stats["max_ms"] = max(stats["max_ms"], duration_ms)
+            stats["routes"][route or "background"] = stats["routes"].get(route or "background", 0) + 1
+            wants_explain = (key[1] in EXPLAINABLE_COMMANDS and stats["plan"] is None
+                             and random.random() < self.explain_sample_rate)
+        if wants_explain and self.database is not None:
+            explain_command = {k: v for k, v in command.items() if k not in COMMAND_META_FIELDS}
+            try:
+                self.explain_queue.put_nowait((key, explain_command))
+                self.start()
+            except queue.Full:
+                pass
+
+    def start(self):
+        if self.explainer is None:
+            with self.lock:
+                if self.explainer is None:
+                    self.explainer = threading.Thread(target=self.run, daemon=True)
+                    self.explainer.start()
+
+    def run(self):
+        while True:
+            self.explain(*self.explain_queue.get())
+
+    def explain(self, key, command):
+        """Run explain off the request path (explain itself is not profiled)"""
+        try:
+            result = self.database.command({"explain": command, "verbosity": "queryPlanner"})
+        except Exception as e:
+            print(f"ERROR: Could not explain slow query: {e}")
+            return
+        stages = plan_stages(result.get('queryPlanner', {}).get('winningPlan', result))
+        with self.lock:
+            stats = self.shapes.get(key)
+            if stats is not None:
+                stats["plan"] = stages
+                stats["collscan"] = 'COLLSCAN' in stages
+
+    def report(self, limit=20):
+        with self.lock:
+            shapes = [dict(stats, routes=dict(stats["routes"]), avg_ms=round(stats["total_ms"] / stats["count"], 2))
+                      for stats in self.shapes.values()]
+        shapes.sort(key=lambda stats: stats["total_ms"], reverse=True)
+        return shapes[:limit]
+
+    def reset(self):
+        with self.lock:
+            self.shapes.clear()
+
+query_profiler = QueryProfiler()
+
 mongo_uri = os.environ.get('MONGO_URI')
-mongo_client = MongoClient(mongo_uri)
+mongo_client = MongoClient(mongo_uri, event_listeners=[query_profiler])
 db = mongo_client.mydatabase
+query_profiler.database = db
 comments_collection = db.comments
 votes_collection = db.votes  
 flags_collection = db.flags
 hidden_reviews_collection = db.hidden_reviews
+rankings_collection = db.content_rankings
+engagement_collection = db.product_engagement
+moderation_stats_collection = db.moderation_stats
+review_snapshots_collection = db.review_snapshots
+flags_archive_collection = db.flags_archive
+comments_archive_collection = db.comments_archive
+votes_archive_collection = db.votes_archive
+
+# Retention policy for the hot collections
+ARCHIVE_RESOLVED_FLAGS_AFTER_DAYS = int(os.getenv('ARCHIVE_RESOLVED_FLAGS_AFTER_DAYS', 30))
+ARCHIVE_REMOVED_COMMENTS_AFTER_DAYS = int(os.getenv('ARCHIVE_REMOVED_COMMENTS_AFTER_DAYS', 30))
+ARCHIVE_TTL_DAYS = int(os.getenv('ARCHIVE_TTL_DAYS', 365))  # 0 keeps archived documents forever
+ARCHIVE_BATCH_SIZE = 500
 
 oauth = OAuth(app)
-nonce = generate_token()
 
 oauth.register(
     name=os.getenv('OIDC_CLIENT_NAME'),
@@ -37,7 +251,131 @@ oauth.register(
     client_kwargs={'scope': 'openid email profile'}
 )
 
+# Identity provider keys are cached; an unknown key id forces a throttled refresh
+JWKS_CACHE_SECONDS = int(os.getenv('JWKS_CACHE_SECONDS', 3600))
+JWKS_MIN_REFRESH_SECONDS = int(os.getenv('JWKS_MIN_REFRESH_SECONDS', 30))
+
+class JWKSCache:
+    """Wrap a client's fetch_jwk_set with a TTL and rate-limited forced refreshes"""
+
+    def __init__(self, fetch, ttl=JWKS_CACHE_SECONDS, min_refresh=JWKS_MIN_REFRESH_SECONDS):
+        self._fetch = fetch
+        self.ttl = ttl
+        self.min_refresh = min_refresh
+        self.lock = threading.Lock()
+        self.keys = None
+        self.fetched_at = 0.0
+
+    def fetch(self, force=False):
+        with self.lock:
+            age = time.monotonic() - self.fetched_at
+            if self.keys is not None:
+                if not force and age < self.ttl:
+                    return self.keys
+                # Key rotation: refresh on an unknown kid, but at most once per min_refresh
+                if force and age < self.min_refresh:
+                    return self.keys
+            self.keys = self._fetch(force=True)
+            self.fetched_at = time.monotonic()
+            return self.keys
 
+oauth_client = None
+oauth_client_lock = threading.Lock()
+
+def get_oauth_client():
+    """The OIDC client, built once per worker"""
+    global oauth_client
+    if oauth_client is None:
+        with oauth_client_lock:
+            if oauth_client is None:
+                client = oauth.create_client(os.getenv('OIDC_CLIENT_NAME'))
+                client.fetch_jwk_set = JWKSCache(client.fetch_jwk_set).fetch
+                oauth_client = client
+    return oauth_client
+
+
+database_ready = False
+database_lock = threading.Lock()
+
+def sync_archive_ttl(archive):
+    """Make the archived_at index match ARCHIVE_TTL_DAYS, including after the setting changes"""
+    ttl = ARCHIVE_TTL_DAYS * 24 * 3600 if ARCHIVE_TTL_DAYS > 0 else None
+    existing = next((
+        (name, info) for name, info in archive.index_information().items()
+        if info.get('key') == [("archived_at", 1)]
+    ), None)
+    if existing is None:
+        if ttl:
+            archive.create_index("archived_at", expireAfterSeconds=ttl)
+        else:
+            archive.create_index("archived_at")
+        return
+    name, info = existing
+    current = info.get('expireAfterSeconds')
+    if current == ttl:
+        return
+    if current is not None and ttl:
+        # collMod changes the TTL in place without rebuilding the index
+        archive.database.command('collMod', archive.name,
+                                 index={"keyPattern": {"archived_at": 1}, "expireAfterSeconds": ttl})
+        return
+    # Turning expiry on or off needs a rebuild
+    archive.drop_index(name)
+    if ttl:
+        archive.create_index("archived_at", expireAfterSeconds=ttl)
+    else:
+        archive.create_index("archived_at")
+
+def ensure_indexes():
+    """Create the indexes the hot queries rely on (idempotent); one failure doesn't skip the rest"""
+    indexes = [
+        (rankings_collection, [("content_type", 1), ("content_id", 1)], {"unique": True}),
+        (rankings_collection, [("article_id", 1), ("content_type", 1), ("wilson_score", -1)], {}),
+        (rankings_collection, [("article_id", 1), ("content_type", 1), ("controversy", -1)], {}),
+        (flags_collection, [("resolved", 1), ("resolved_at", 1)], {}),
+        (comments_collection, [("is_removed", 1), ("removed_at", 1)], {}),
+        (comments_collection, [("article_id", 1), ("created_at", -1)], {}),
+        (comments_collection, [("content", "text"), ("redacted_content", "text")], {"name": "comment_text"}),
+        (hidden_reviews_collection, [("review_id", 1)], {}),
+        (votes_archive_collection, [("content_type", 1), ("content_id", 1)], {}),
+        (votes_collection, [("content_type", 1), ("content_id", 1), ("user_email", 1)],
+         {"unique": True, "partialFilterExpression": {"content_id": {"$exists": True}}}),
+        (votes_collection, [("content_type", 1), ("content_id", 1), ("vote_type", 1)], {}),
+        (engagement_collection, [("article_id", 1)], {"unique": True}),
+        (moderation_stats_collection, [("type", 1), ("day", 1)], {}),
+        (review_snapshots_collection, [("article_id", 1), ("review_index", 1)], {}),
+    ]
+    indexes += [(engagement_collection, [(field, -1), ("product_id", 1)], {})
+                for field in COMMUNITY_SORT_FIELDS.values()]
+    for collection, keys, options in indexes:
+        try:
+            collection.create_index(keys, **options)
+        except Exception as e:
+            print(f"ERROR: Could not create index {keys} on {collection.name}: {e}")
+    for archive in (flags_archive_collection, comments_archive_collection, votes_archive_collection):
+        try:
+            sync_archive_ttl(archive)
+        except Exception as e:
+            print(f"ERROR: Could not update archive TTL on {archive.name}: {e}")
+
+@app.before_request
+def prepare_database_once():
+    """Create indexes and start pending data migrations on the first request"""
+    global database_ready
+    if database_ready:
+        return
+    with database_lock:
+        if database_ready:
+            return
+        try:
+            ensure_indexes()
+        except Exception as e:
+            print(f"ERROR: Could not create indexes: {e}")
+        try:
+            start_review_vote_migration()
+        except Exception as e:
+            print(f"ERROR: Could not start review vote migration: {e}")
+        database_ready = True
 
 def login_required(f):
     @wraps(f)
@@ -47,12 +385,17 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+MODERATOR_EMAILS = ('moderator@hw3.com', 'admin@hw3.com')
+
+def is_moderator():
+    return 'user' in session and session['user'].get('email') in MODERATOR_EMAILS
+
 def moderator_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
         if 'user' not in session:
             return jsonify({"error": "Authentication required"}), 401
-        if session['user'].get('email') != 'moderator@hw3.com' and session['user'].get('email') != 'admin@hw3.com':
+        if not is_moderator():
             return jsonify({"error": "Moderator privileges required"}), 403
         return f(*args, **kwargs)
     return decorated_function
@@ -84,28 +427,29 @@ def auth_status():
         })
     return jsonify({"authenticated": False})
 
-@app.route('/login')
-def login():
+def start_login():
+    # Fresh nonce per login attempt; authlib keeps the state in the session too
+    nonce = generate_token()
     session['nonce'] = nonce
     redirect_uri = 'http://localhost:8000/authorize'
-    client_name = os.getenv('OIDC_CLIENT_NAME')
-    return oauth.create_client(client_name).authorize_redirect(redirect_uri, nonce=nonce)
+    return get_oauth_client().authorize_redirect(redirect_uri, nonce=nonce)
+
+@app.route('/login')
+def login():
+    return start_login()
 
 @app.route('/api/auth/login')
 def api_login():
     """API endpoint for login"""
-    session['nonce'] = nonce
-    redirect_uri = 'http://localhost:8000/authorize'
-    client_name = os.getenv('OIDC_CLIENT_NAME')
-    return oauth.create_client(client_name).authorize_redirect(redirect_uri, nonce=nonce)
+    return start_login()
 
 
 @app.route('/authorize')
 def authorize():
-    client_name = os.getenv('OIDC_CLIENT_NAME')
-    token = oauth.create_client(client_name).authorize_access_token()
-    nonce = session.get('nonce')
-    user_info = oauth.create_client(client_name).parse_id_token(token, nonce=nonce)  # or use .get('userinfo').json()
+    client = get_oauth_client()
+    token = client.authorize_access_token()
+    nonce = session.pop('nonce', None)
+    user_info = client.parse_id_token(token, nonce=nonce)  # or use .get('userinfo').json()
     session['user'] = user_info
     return redirect('http://localhost:5173')
 
@@ -120,67 +464,1114 @@ def logout_redirect():
     return redirect('/')
 
 
-def get_review_votes(review_id):
-    upvotes = votes_collection.count_documents({"review_id": review_id, "vote_type": "up"})
-    downvotes = votes_collection.count_documents({"review_id": review_id, "vote_type": "down"})
+# Live event stream (in-process pub/sub fed by the write routes)
+STREAM_HEARTBEAT_SECONDS = 15
+STREAM_REPLAY_BUFFER_SIZE = 200
+STREAM_SUBSCRIBER_BUFFER_SIZE = 100
+
+class EventBroker:
+    """Fan out events per article to SSE subscribers, keeping a short replay log"""
+
+    def __init__(self, replay_size=STREAM_REPLAY_BUFFER_SIZE, subscriber_size=STREAM_SUBSCRIBER_BUFFER_SIZE):
+        self.replay_size = replay_size
+        self.subscriber_size = subscriber_size
+        self.lock = threading.Lock()
+        self.last_id = 0
+        self.history = {}      # article_id -> deque of events
+        self.subscribers = {}  # article_id -> set of queues
+
+    def has_subscribers(self, article_id=None):
+        with self.lock:
+            if article_id is None:
+                return any(self.subscribers.values())
+            return bool(self.subscribers.get(article_id))
+
+    def publish(self, article_id, event_type, data):
+        with self.lock:
+            self.last_id += 1
+            event = {"id": self.last_id, "event": event_type, "data": data}
+            self.history.setdefault(article_id, deque(maxlen=self.replay_size)).append(event)
+            for subscriber in list(self.subscribers.get(article_id, ())):
+                try:
+                    subscriber.put_nowait(event)
+                except queue.Full:
+                    # Slow consumer: drop it, the client resumes with Last-Event-ID
+                    self.subscribers[article_id].discard(subscriber)
+                    subscriber.overflowed = True
+        return event
+
+    def subscribe(self, article_id, last_event_id=None):
+        """Register a subscriber and return (queue, events to replay)"""
+        subscriber = queue.Queue(maxsize=self.subscriber_size)
+        subscriber.overflowed = False
+        with self.lock:
+            replay = []
+            if last_event_id is not None:
+                replay = [event for event in self.history.get(article_id, ()) if event["id"] > last_event_id]
+            self.subscribers.setdefault(article_id, set()).add(subscriber)
+        return subscriber, replay
+
+    def unsubscribe(self, article_id, subscriber):
+        with self.lock:
+            self.subscribers.get(article_id, set()).discard(subscriber)
+
+    def reset(self):
+        with self.lock:
+            self.last_id = 0
+            self.history.clear()
+            self.subscribers.clear()
+
+event_broker = EventBroker()
+
+def format_sse(event):
+    return f"id: {event['id']}\nevent: {event['event']}\ndata: {app.json.dumps(event['data'])}\n\n"
+
+def article_id_for_review(review_id):
+    """Reviews are keyed product_{id}_review_{i}; their stream is the product's article"""
+    match = re.match(r'^(product_\d+)_review_\d+$', review_id or '')
+    return match.group(1) if match else None
+
+def publish_comment_event(comment_id, event_type, data, article_id=None):
+    """Publish a comment event, looking up its article when the caller doesn't know it"""
+    if article_id is None:
+        comment = comments_collection.find_one({"_id": ObjectId(comment_id)}, {"article_id": 1})
+        if not comment:
+            return
+        article_id = comment['article_id']
+    event_broker.publish(article_id, event_type, dict(data, comment_id=comment_id))
+
+@app.route('/api/stream/<article_id>')
+def stream_article_events(article_id):
+    """Server-Sent Events stream of new comments, moderation changes and vote counts"""
+    last_event_id = request.headers.get('Last-Event-ID', request.args.get('last_event_id'))
+    try:
+        last_event_id = int(last_event_id) if last_event_id is not None else None
+    except ValueError:
+        return jsonify({"error": "Invalid Last-Event-ID"}), 400
+
+    subscriber, replay = event_broker.subscribe(article_id, last_event_id)
+
+    def generate():
+        try:
+            yield f"retry: {STREAM_HEARTBEAT_SECONDS * 1000}\n\n"
+            for event in replay:
+                yield format_sse(event)
+            while not subscriber.overflowed:
+                try:
+                    event = subscriber.get(timeout=STREAM_HEARTBEAT_SECONDS)
+                except queue.Empty:
+                    yield ": heartbeat\n\n"
+                    continue
+                yield format_sse(event)
+        finally:
+            event_broker.unsubscribe(article_id, subscriber)
+
+    return Response(generate(), mimetype='text/event-stream', headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
+
+
+# Content votes: one engine and one schema, keyed by (content_type, content_id)
+VOTE_CONTENT_TYPES = ['review', 'comment']
+VOTE_MIGRATION_BATCH_SIZE = 1000
+
+# Review votes used to be stored as {review_id}; until they are migrated reads match both shapes
+review_votes_migrated = False
+
+def vote_target(content_type, content_id):
+    """Filter selecting the votes on one piece of content"""
+    target = {"content_type": content_type, "content_id": content_id}
+    if content_type == 'review' and not review_votes_migrated:
+        return {"$or": [target, {"review_id": content_id}]}
+    return target
+
+def migrate_review_votes(batch_size=VOTE_MIGRATION_BATCH_SIZE):
+    """Rewrite legacy {review_id} votes into the (content_type, content_id) schema in batches"""
+    global review_votes_migrated
+    migrated = 0
+    while True:
+        batch = list(votes_collection.find({"review_id": {"$exists": True}}, {"review_id": 1}).limit(batch_size))
+        if not batch:
+            break
+        votes_collection.bulk_write([UpdateOne(
+            {"_id": vote["_id"]},
+            {"$set": {"content_type": "review", "content_id": vote["review_id"]}, "$unset": {"review_id": ""}}
+        ) for vote in batch], ordered=False)
+        migrated += len(batch)
+    review_votes_migrated = True
+    return migrated
+
+def start_review_vote_migration():
+    """Migrate legacy review votes in the background if any are left"""
+    global review_votes_migrated
+    if votes_collection.find_one({"review_id": {"$exists": True}}, {"_id": 1}) is None:
+        review_votes_migrated = True
+        return
+    threading.Thread(target=migrate_review_votes, daemon=True).start()
+
+# Write-behind vote buffering for vote storms (off by default)
+VOTE_BUFFER_ENABLED = os.getenv('VOTE_BUFFER_ENABLED', 'false').lower() == 'true'
+VOTE_BUFFER_FLUSH_SECONDS = float(os.getenv('VOTE_BUFFER_FLUSH_SECONDS', 2))
+VOTE_BUFFER_MAX_PENDING = int(os.getenv('VOTE_BUFFER_MAX_PENDING', 1000))
+
+class VoteBuffer:
+    """Coalesce vote intents in memory and write only each user's final vote in bulk"""
+
+    def __init__(self, enabled=VOTE_BUFFER_ENABLED, flush_interval=VOTE_BUFFER_FLUSH_SECONDS,
+                 max_pending=VOTE_BUFFER_MAX_PENDING):
+        self.enabled = enabled
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.pending = {}  # (content_type, content_id, user_email) -> entry
+        self.in_flight = {}  # batch being written; still counted until the write returns
+        self.flusher = None
+        self.started = False
+
+    def record(self, content_type, content_id, user_email, vote_type):
+        """Toggle a user's vote like the synchronous path and return the action taken"""
+        key = (content_type, content_id, user_email)
+        with self.lock:
+            entry = self.pending.get(key)
+            writing = self.in_flight.get(key)
+        if writing is not None:
+            previous = writing['vote_type']
+        elif entry is None:
+            existing_vote = votes_collection.find_one(
+                dict(vote_target(content_type, content_id), user_email=user_email), {"vote_type": 1}
+            )
+            previous = existing_vote['vote_type'] if existing_vote else None
+
+        with self.lock:
+            entry = self.pending.get(key)
+            if entry is None:
+                entry = {"previous": previous, "vote_type": previous}
+                self.pending[key] = entry
+            current = entry['vote_type']
+            if current == vote_type:
+                entry['vote_type'] = None
+                action = "removed"
+            else:
+                entry['vote_type'] = vote_type
+                action = "updated" if current else "added"
+            entry['updated_at'] = datetime.now(timezone.utc)
+            should_flush = len(self.pending) >= self.max_pending
+
+        self.start()
+        if should_flush:
+            try:
+                self.flush()
+            except Exception as e:
+                # The vote stays buffered; failing the request would make the user toggle it again
+                print(f"ERROR: Vote buffer flush failed: {e}")
+        return action
+
+    def user_vote(self, content_type, content_id, user_email):
+        """(True, vote_type) when the user has a pending vote on the content"""
+        key = (content_type, content_id, user_email)
+        with self.lock:
+            entry = self.pending.get(key) or self.in_flight.get(key)
+            return (True, entry['vote_type']) if entry else (False, None)
+
+    def count_delta(self, content_type, content_id):
+        """Pending change to (upvotes, downvotes) for content that is not yet in Mongo"""
+        up = down = 0
+        with self.lock:
+            for entries in (self.in_flight, self.pending):
+                for (entry_type, entry_id, _), entry in entries.items():
+                    if entry_type != content_type or entry_id != content_id:
+                        continue
+                    up += (entry['vote_type'] == 'up') - (entry['previous'] == 'up')
+                    down += (entry['vote_type'] == 'down') - (entry['previous'] == 'down')
+        return up, down
+
+    def flush(self):
+        """Write every pending vote in one bulk write; failed batches are kept for the next flush"""
+        with self.flush_lock:
+            with self.lock:
+                batch, self.pending = self.pending, {}
+                self.in_flight = batch
+            operations = []
+            for (content_type, content_id, user_email), entry in batch.items():
+                vote_filter = dict(vote_target(content_type, content_id), user_email=user_email)
+                if entry['vote_type'] is None:
+                    if entry['previous'] is not None:
+                        operations.append(DeleteOne(vote_filter))
+                elif entry['vote_type'] != entry['previous']:
+                    operations.append(UpdateOne(vote_filter, {
+                        "$set": {
+                            "content_type": content_type,
+                            "content_id": content_id,
+                            "vote_type": entry['vote_type'],
+                            "updated_at": entry['updated_at']
+                        },
+                        "$unset": {"review_id": ""},
+                        "$setOnInsert": {"created_at": entry['updated_at']}
+                    }, upsert=True))
+            try:
+                if operations:
+                    votes_collection.bulk_write(operations, ordered=False)
+            except Exception:
+                with self.lock:
+                    for key, entry in batch.items():
+                        if key in self.pending:
+                            self.pending[key]['previous'] = entry['previous']
+                        else:
+                            self.pending[key] = entry
+                    self.in_flight = {}
+                raise
+            with self.lock:
+                self.in_flight = {}
+            return len(operations)
+
+    def start(self):
+        """Start the periodic flusher and the exit flush the first time a vote is buffered"""
+        if self.started:
+            return
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+            if self.flush_interval:
+                self.flusher = threading.Thread(target=self.run, daemon=True)
+                self.flusher.start()
+        atexit.register(self.flush)
+
+    def run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"ERROR: Vote buffer flush failed: {e}")
+
+vote_buffer = VoteBuffer()
+
+def count_votes(content_type, content_id):
+    """Vote counts for content, including votes still waiting in the buffer"""
+    target = vote_target(content_type, content_id)
+    upvotes = votes_collection.count_documents(dict(target, vote_type="up"))
+    downvotes = votes_collection.count_documents(dict(target, vote_type="down"))
+    if vote_buffer.enabled:
+        pending_up, pending_down = vote_buffer.count_delta(content_type, content_id)
+        upvotes += pending_up
+        downvotes += pending_down
     return {
         "upvotes": upvotes,
         "downvotes": downvotes,
         "score": upvotes - downvotes
     }
 
+def get_review_votes(review_id):
+    return count_votes('review', review_id)
+
+def stored_vote_counts(content_type, id_condition):
+    """Stored (upvotes, downvotes) for every item matching id_condition, in one aggregation"""
+    match = {"content_type": content_type, "content_id": id_condition}
+    if content_type == 'review' and not review_votes_migrated:
+        match = {"$or": [match, {"review_id": id_condition}]}
+    rows = votes_collection.aggregate([
+        {"$match": match},
+        {"$group": {
+            "_id": {"$ifNull": ["$content_id", "$review_id"]},
+            "upvotes": {"$sum": {"$cond": [{"$eq": ["$vote_type", "up"]}, 1, 0]}},
+            "downvotes": {"$sum": {"$cond": [{"$eq": ["$vote_type", "down"]}, 1, 0]}}
+        }}
+    ])
+    return {row["_id"]: (row["upvotes"], row["downvotes"]) for row in rows}
+
+def votes_info_for(content_type, content_ids, stored):
+    """Vote payloads for several items: stored counts plus anything still in the buffer"""
+    result = {}
+    for content_id in content_ids:
+        upvotes, downvotes = stored.get(content_id, (0, 0))
+        if vote_buffer.enabled:
+            pending_up, pending_down = vote_buffer.count_delta(content_type, content_id)
+            upvotes += pending_up
+            downvotes += pending_down
+        result[content_id] = {"upvotes": upvotes, "downvotes": downvotes, "score": upvotes - downvotes}
+    return result
+
+def stored_user_votes(content_type, id_condition, user_email):
+    """A user's stored votes on every item matching id_condition"""
+    match = {"content_type": content_type, "content_id": id_condition, "user_email": user_email}
+    if content_type == 'review' and not review_votes_migrated:
+        match = {"$or": [match, {"review_id": id_condition, "user_email": user_email}]}
+    return {
+        vote.get("content_id", vote.get("review_id")): vote["vote_type"]
+        for vote in votes_collection.find(match, {"content_id": 1, "review_id": 1, "vote_type": 1})
+    }
+
+def user_votes_for(content_type, content_ids, user_email, stored):
+    """A user's votes on several items, with their own buffered votes taking precedence"""
+    result = {}
+    for content_id in content_ids:
+        vote_type = stored.get(content_id)
+        if vote_buffer.enabled:
+            is_pending, pending_type = vote_buffer.user_vote(content_type, content_id, user_email)
+            if is_pending:
+                vote_type = pending_type
+        if vote_type:
+            result[content_id] = vote_type
+    return result
+
+def apply_vote(content_type, content_id, user_email, vote_type):
+    """Add, change or toggle off a user's vote on content and return the action taken"""
+    if vote_buffer.enabled:
+        return vote_buffer.record(content_type, content_id, user_email, vote_type)
+
+    existing_vote = votes_collection.find_one(dict(vote_target(content_type, content_id), user_email=user_email))
+
+    if existing_vote:
+        if existing_vote['vote_type'] == vote_type:
+            votes_collection.delete_one({"_id": existing_vote['_id']})
+            return "removed"
+        votes_collection.update_one(
+            {"_id": existing_vote['_id']},
+            {
+                "$set": {
+                    "content_type": content_type,
+                    "content_id": content_id,
+                    "vote_type": vote_type,
+                    "updated_at": datetime.now(timezone.utc)
+                },
+                "$unset": {"review_id": ""}
+            }
+        )
+        return "updated"
+
+    votes_collection.insert_one({
+        "content_type": content_type,
+        "content_id": content_id,
+        "user_email": user_email,
+        "vote_type": vote_type,
+        "created_at": datetime.now(timezone.utc)
+    })
+    return "added"
+
+def get_user_vote_type(content_type, content_id, user_email):
+    """The user's current vote on content, seeing their own buffered votes first"""
+    if vote_buffer.enabled:
+        is_pending, vote_type = vote_buffer.user_vote(content_type, content_id, user_email)
+        if is_pending:
+            return vote_type
+    user_vote = votes_collection.find_one(dict(vote_target(content_type, content_id), user_email=user_email))
+    return user_vote['vote_type'] if user_vote else None
+
+def handle_vote(content_type, content_id):
+    """Shared body of the vote routes: apply the vote, then refresh rankings and live streams"""
+    data = request.json
+    vote_type = data.get('vote_type')  # 'up' or 'down'
+    
+    if vote_type not in ['up', 'down']:
+        return jsonify({"error": "Invalid vote type. Must be 'up' or 'down'"}), 400
+    
+    user_email = session['user'].get('email')
+    
+    try:
+        action = apply_vote(content_type, content_id, user_email, vote_type)
+        votes_info = count_votes(content_type, content_id)
+
+        if content_type == 'review':
+            article_id = article_id_for_review(content_id)
+            if article_id:
+                update_ranking('review', content_id, votes_info, article_id)
+                event_broker.publish(article_id, "review_votes", {"review_id": content_id, "votes": votes_info})
+        else:
+            article_id = update_ranking(content_type, content_id, votes_info)
+            publish_comment_event(content_id, "comment_votes", {"votes": votes_info}, article_id)
+        if article_id:
+            record_engagement(article_id, vote_score=vote_score_delta(action, vote_type),
+                              activity=0 if action == "removed" else TRENDING_VOTE_WEIGHT)
+        
+        return jsonify({
+            "success": True,
+            "action": action,
+            "votes": votes_info
+        })
+        
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Confidence-adjusted ranking, updated on every vote
+RANKING_SORTS = ['top', 'controversial', 'new']
+WILSON_Z = 1.96
+
+def wilson_lower_bound(upvotes, downvotes, z=WILSON_Z):
+    """Lower bound of the Wilson score interval for the share of upvotes"""
+    n = upvotes + downvotes
+    if n <= 0:
+        return 0.0
+    p = upvotes / n
+    return (p + z * z / (2 * n) - z * math.sqrt((p * (1 - p) + z * z / (4 * n)) / n)) / (1 + z * z / n)
+
+def controversy_score(upvotes, downvotes):
+    """High when there are many votes split close to evenly"""
+    if upvotes <= 0 or downvotes <= 0:
+        return 0.0
+    balance = min(upvotes, downvotes) / max(upvotes, downvotes)
+    return (upvotes + downvotes) ** balance
+
+def update_ranking(content_type, content_id, votes_info, article_id=None):
+    """Store the latest scores for a review or comment in its article's leaderboard"""
+    ranking = {
+        "upvotes": votes_info["upvotes"],
+        "downvotes": votes_info["downvotes"],
+        "score": votes_info["score"],
+        "wilson_score": wilson_lower_bound(votes_info["upvotes"], votes_info["downvotes"]),
+        "controversy": controversy_score(votes_info["upvotes"], votes_info["downvotes"]),
+        "updated_at": datetime.now(timezone.utc)
+    }
+    key = {"content_type": content_type, "content_id": content_id}
+    if article_id is None:
+        existing = rankings_collection.find_one_and_update(key, {"$set": ranking}, {"article_id": 1})
+        if existing:
+            return existing.get('article_id')
+        # First vote on this comment: look up which article it belongs to
+        comment = comments_collection.find_one({"_id": ObjectId(content_id)}, {"article_id": 1})
+        if not comment:
+            return None
+        article_id = comment['article_id']
+    ranking["article_id"] = article_id
+    rankings_collection.update_one(key, {"$set": ranking}, upsert=True)
+    return article_id
+
+def rebuild_rankings(batch_size=500):
+    """Recompute every leaderboard row from the stored votes (backfills content voted on before rankings existed)"""
+    rows = votes_collection.aggregate([
+        {"$group": {
+            "_id": {
+                "content_type": {"$ifNull": ["$content_type", "review"]},
+                "content_id": {"$ifNull": ["$content_id", "$review_id"]}
+            },
+            "upvotes": {"$sum": {"$cond": [{"$eq": ["$vote_type", "up"]}, 1, 0]}},
+            "downvotes": {"$sum": {"$cond": [{"$eq": ["$vote_type", "down"]}, 1, 0]}}
+        }}
+    ])
+    rebuilt = 0
+    batch = []
+
+    def write(batch):
+        comment_ids = [ObjectId(row["_id"]["content_id"]) for row in batch
+                       if row["_id"]["content_type"] == 'comment' and ObjectId.is_valid(row["_id"]["content_id"])]
+        comment_articles = {
+            str(comment["_id"]): comment["article_id"]
+            for comment in comments_collection.find({"_id": {"$in": comment_ids}}, {"article_id": 1})
+        } if comment_ids else {}
+        now = datetime.now(timezone.utc)
+        operations = []
+        for row in batch:
+            content_type, content_id = row["_id"]["content_type"], row["_id"]["content_id"]
+            if content_type == 'review':
+                article_id = article_id_for_review(content_id)
+            else:
+                article_id = comment_articles.get(content_id)
+            if not article_id:
+                continue
+            upvotes, downvotes = row["upvotes"], row["downvotes"]
+            operations.append(UpdateOne(
+                {"content_type": content_type, "content_id": content_id},
+                {"$set": {
+                    "article_id": article_id,
+                    "upvotes": upvotes,
+                    "downvotes": downvotes,
+                    "score": upvotes - downvotes,
+                    "wilson_score": wilson_lower_bound(upvotes, downvotes),
+                    "controversy": controversy_score(upvotes, downvotes),
+                    "updated_at": now
+                }},
+                upsert=True
+            ))
+        if operations:
+            rankings_collection.bulk_write(operations, ordered=False)
+        return len(operations)
+
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            rebuilt += write(batch)
+            batch = []
+    if batch:
+        rebuilt += write(batch)
+    return rebuilt
+
+@app.cli.command('rebuild-rankings')
+def rebuild_rankings_command():
+    """Recompute review and comment leaderboards from the votes collection"""
+    print(f"Rebuilt {rebuild_rankings()} rankings")
+
+def ranked_content_ids(article_id, content_type, sort):
+    """Content ids of an article in leaderboard order, read straight from the index"""
+    sort_field = "controversy" if sort == 'controversial' else "wilson_score"
+    rankings = rankings_collection.find(
+        {"article_id": article_id, "content_type": content_type},
+        {"content_id": 1}
+    ).sort([(sort_field, -1), ("score", -1)])
+    return [ranking["content_id"] for ranking in rankings]
+
+def sort_by_ranking(items, item_id, article_id, content_type, sort, ranked_ids=None):
+    """Order items by the stored ranking; unvoted items keep their order at the end"""
+    if ranked_ids is None:
+        ranked_ids = ranked_content_ids(article_id, content_type, sort)
+    positions = {content_id: i for i, content_id in enumerate(ranked_ids)}
+    return sorted(items, key=lambda item: positions.get(item_id(item), len(positions)))
+
+# Circuit breaker and last-known-good fallback for the DummyJSON upstream
+UPSTREAM_TIMEOUT_SECONDS = float(os.getenv('UPSTREAM_TIMEOUT_SECONDS', 5))
+UPSTREAM_SLOW_CALL_SECONDS = float(os.getenv('UPSTREAM_SLOW_CALL_SECONDS', 2))
+UPSTREAM_FAILURE_RATE_THRESHOLD = float(os.getenv('UPSTREAM_FAILURE_RATE_THRESHOLD', 0.5))
+UPSTREAM_MIN_CALLS = int(os.getenv('UPSTREAM_MIN_CALLS', 10))
+UPSTREAM_WINDOW_SIZE = int(os.getenv('UPSTREAM_WINDOW_SIZE', 50))
+UPSTREAM_OPEN_SECONDS = float(os.getenv('UPSTREAM_OPEN_SECONDS', 30))
+UPSTREAM_STALE_CACHE_SIZE = 500
+
+class CircuitOpenError(Exception):
+    """The upstream circuit is open and there is no last known good response"""
+
+    def __init__(self, retry_after):
+        super().__init__("Product service temporarily unavailable")
+        self.retry_after = retry_after
+
+class CircuitBreaker:
+    """Closed -> open on a high failure/slow-call rate, half-open single probe after a cooldown"""
+
+    def __init__(self, failure_rate_threshold=UPSTREAM_FAILURE_RATE_THRESHOLD, min_calls=UPSTREAM_MIN_CALLS,
+                 window_size=UPSTREAM_WINDOW_SIZE, open_seconds=UPSTREAM_OPEN_SECONDS,
+                 slow_call_seconds=UPSTREAM_SLOW_CALL_SECONDS):
+        self.failure_rate_threshold = failure_rate_threshold
+        self.min_calls = min_calls
+        self.open_seconds = open_seconds
+        self.slow_call_seconds = slow_call_seconds
+        self.lock = threading.Lock()
+        self.outcomes = deque(maxlen=window_size)  # True for a failed or slow call
+        self.state = 'closed'
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.stats = {"calls": 0, "failures": 0, "slow_calls": 0, "rejected": 0, "stale_served": 0, "opened": 0}
+
+    def allow_request(self):
+        with self.lock:
+            if self.state == 'open' and time.monotonic() - self.opened_at >= self.open_seconds:
+                self.state = 'half_open'
+            if self.state == 'closed':
+                return True
+            if self.state == 'half_open' and not self.probe_in_flight:
+                self.probe_in_flight = True
+                return True
+            self.stats["rejected"] += 1
+            return False
+
+    def retry_after(self):
+        with self.lock:
+            return max(1, int(self.open_seconds - (time.monotonic() - self.opened_at)))
+
+    def record(self, failed, elapsed=0.0):
+        with self.lock:
+            slow = not failed and elapsed > self.slow_call_seconds
+            self.stats["calls"] += 1
+            self.stats["failures"] += failed
+            self.stats["slow_calls"] += slow
+            if self.state == 'half_open':
+                self.probe_in_flight = False
+                if failed or slow:
+                    self.trip()
+                else:
+                    self.state = 'closed'
+                    self.outcomes.clear()
+                return
+            self.outcomes.append(failed or slow)
+            if len(self.outcomes) >= self.min_calls and self.failure_rate() >= self.failure_rate_threshold:
+                self.trip()
+
+    def trip(self):
+        self.state = 'open'
+        self.opened_at = time.monotonic()
+        self.outcomes.clear()
+        self.stats["opened"] += 1
+
+    def failure_rate(self):
+        return sum(self.outcomes) / len(self.outcomes) if self.outcomes else 0.0
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.stats, state=self.state, failure_rate=round(self.failure_rate(), 3),
+                        window_calls=len(self.outcomes))
+
+upstream_breaker = CircuitBreaker()
+upstream_stale_cache = OrderedDict()  # (url, params) -> (fetched_at, raw response body)
+upstream_stale_lock = threading.Lock()
+
+def get_stale_upstream(key):
+    with upstream_stale_lock:
+        cached = upstream_stale_cache.get(key)
+    if cached is None:
+        return None
+    with upstream_breaker.lock:
+        upstream_breaker.stats["stale_served"] += 1
+    return app.json.loads(cached[1]), time.time() - cached[0]
+
+class UpstreamClientError(Exception):
+    """A 4xx from upstream: the request was bad, not the upstream, so it is passed through"""
+
+    def __init__(self, status_code, payload):
+        super().__init__(f"Upstream rejected the request ({status_code})")
+        self.status_code = status_code
+        self.payload = payload
+
+def fetch_upstream(url, params=None):
+    """GET a DummyJSON resource through the breaker: (data, status_code, stale_age or None)"""
+    key = (url, tuple(sorted((params or {}).items())))
+    if not upstream_breaker.allow_request():
+        stale = get_stale_upstream(key)
+        if stale is None:
+            raise CircuitOpenError(upstream_breaker.retry_after())
+        return stale[0], 200, stale[1]
+
+    started = time.monotonic()
+    try:
+        response = requests.get(url, params=params, timeout=UPSTREAM_TIMEOUT_SECONDS)
+        if response.status_code == 404:
+            upstream_breaker.record(False, time.monotonic() - started)
+            return None, 404, None
+        try:
+            response.raise_for_status()
+        except requests.HTTPError:
+            if response.status_code >= 500:
+                raise
+            upstream_breaker.record(False, time.monotonic() - started)
+            try:
+                payload = response.json()
+            except ValueError:
+                payload = {"error": response.text}
+            raise UpstreamClientError(response.status_code, payload)
+        data = response.json()
+    except UpstreamClientError:
+        raise
+    except Exception:
+        upstream_breaker.record(True)
+        stale = get_stale_upstream(key)
+        if stale is None:
+            raise
+        return stale[0], 200, stale[1]
+    upstream_breaker.record(False, time.monotonic() - started)
+
+    with upstream_stale_lock:
+        # Keep the raw body: re-parsing on the rare stale read beats copying every fresh payload
+        upstream_stale_cache[key] = (time.time(), response.content)
+        upstream_stale_cache.move_to_end(key)
+        while len(upstream_stale_cache) > UPSTREAM_STALE_CACHE_SIZE:
+            upstream_stale_cache.popitem(last=False)
+    return data, response.status_code, None
+
+def upstream_response(data, stale_age):
+    response = jsonify(data)
+    if stale_age is not None:
+        response.headers['X-Upstream-Stale'] = 'true'
+        response.headers['Age'] = str(int(stale_age))
+    return response
+
+def upstream_client_error_response(e):
+    return jsonify(e.payload), e.status_code
+
+def circuit_open_response(e):
+    response = jsonify({"error": str(e)})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response
+
+@app.route('/api/metrics/upstream')
+def get_upstream_metrics():
+    """Circuit breaker state and counters for the product upstream"""
+    metrics = upstream_breaker.snapshot()
+    with upstream_stale_lock:
+        metrics["stale_cache_entries"] = len(upstream_stale_cache)
+    return jsonify(metrics)
+
+# Community engagement per product, maintained incrementally for sorted listings
+COMMUNITY_SORT_FIELDS = {
+    'most_comments': 'comment_count',
+    'top_voted': 'vote_score',
+    'trending': 'trending_score'
+}
+TRENDING_HALF_LIFE_HOURS = float(os.getenv('TRENDING_HALF_LIFE_HOURS', 48))
+TRENDING_EPOCH = datetime(2025, 1, 1, tzinfo=timezone.utc)
+TRENDING_COMMENT_WEIGHT = 2
+TRENDING_VOTE_WEIGHT = 1
+UPSTREAM_POOL_SIZE = int(os.getenv('UPSTREAM_POOL_SIZE', 8))
+
+upstream_pool = ThreadPoolExecutor(max_workers=UPSTREAM_POOL_SIZE)
+
+def trending_increment(weight, now=None):
+    """Activity weight scaled up over time; ordering by the running sum equals ordering by decayed activity"""
+    now = now or datetime.now(timezone.utc)
+    hours = (now - TRENDING_EPOCH).total_seconds() / 3600
+    return weight * 2 ** (hours / TRENDING_HALF_LIFE_HOURS)
+
+def vote_score_delta(action, vote_type):
+    sign = 1 if vote_type == 'up' else -1
+    return {"added": sign, "removed": -sign, "updated": 2 * sign}[action]
+
+def record_engagement(article_id, comments=0, vote_score=0, activity=0):
+    """Bump a product's engagement counters (other articles are ignored)"""
+    match = re.match(r'^product_(\d+)$', article_id or '')
+    if not match:
+        return
+    now = datetime.now(timezone.utc)
+    engagement_collection.update_one(
+        {"article_id": article_id},
+        {
+            "$inc": {
+                "comment_count": comments,
+                "vote_score": vote_score,
+                "trending_score": trending_increment(activity, now) if activity else 0
+            },
+            "$set": {"last_activity_at": now},
+            "$setOnInsert": {"product_id": int(match.group(1))}
+        },
+        upsert=True
+    )
+
+def rebuild_product_engagement():
+    """Recompute comment counts and vote scores from comments and votes (trending is kept)"""
+    totals = {}
+
+    def entry(article_id):
+        return totals.setdefault(article_id, {"comment_count": 0, "vote_score": 0})
+
+    for row in comments_collection.aggregate([{"$group": {"_id": "$article_id", "count": {"$sum": 1}}}]):
+        entry(row["_id"])["comment_count"] = row["count"]
+
+    score_expr = {"$sum": {"$cond": [{"$eq": ["$vote_type", "up"]}, 1, -1]}}
+    for row in votes_collection.aggregate([
+        {"$match": {"content_type": "review"}},
+        {"$group": {"_id": "$content_id", "score": score_expr}}
+    ]):
+        article_id = article_id_for_review(row["_id"])
+        if article_id:
+            entry(article_id)["vote_score"] += row["score"]
+
+    comment_scores = {row["_id"]: row["score"] for row in votes_collection.aggregate([
+        {"$match": {"content_type": "comment"}},
+        {"$group": {"_id": "$content_id", "score": score_expr}}
+    ])}
+    comment_ids = [ObjectId(comment_id) for comment_id in comment_scores if ObjectId.is_valid(comment_id)]
+    for comment in comments_collection.find({"_id": {"$in": comment_ids}}, {"article_id": 1}):
+        entry(comment["article_id"])["vote_score"] += comment_scores[str(comment["_id"])]
+
+    operations = []
+    for article_id, counts in totals.items():
+        match = re.match(r'^product_(\d+)$', article_id or '')
+        if match:
+            operations.append(UpdateOne(
+                {"article_id": article_id},
+                {"$set": counts, "$setOnInsert": {"product_id": int(match.group(1)), "trending_score": 0}},
+                upsert=True
+            ))
+    if operations:
+        engagement_collection.bulk_write(operations, ordered=False)
+    return len(operations)
+
+@app.cli.command('rebuild-engagement')
+def rebuild_engagement_command():
+    """Recompute per-product engagement counters"""
+    print(f"Rebuilt engagement for {rebuild_product_engagement()} products")
+
+def get_community_sorted_products(sort, limit, skip, fields):
+    """A page of products ordered by engagement, fetched from upstream concurrently"""
+    sort_field = COMMUNITY_SORT_FIELDS[sort]
+    total = engagement_collection.count_documents({})
+    page = list(engagement_collection.find({}, {"product_id": 1, "comment_count": 1, "vote_score": 1})
+                .sort([(sort_field, -1), ("product_id", 1)]).skip(skip).limit(limit))
+
+    select = upstream_select(fields)
+    params = {'select': select} if select else None
+    futures = [
+        upstream_pool.submit(fetch_upstream, f"{DUMMYJSON_BASE_URL}/products/{row['product_id']}", params)
+        for row in page
+    ]
+    products = []
+    stale = False
+    for row, future in zip(page, futures):
+        data, status_code, stale_age = future.result()
+        if status_code == 404 or data is None:
+            continue
+        stale = stale or stale_age is not None
+        data['engagement'] = {"comment_count": row.get("comment_count", 0), "vote_score": row.get("vote_score", 0)}
+        products.append(data)
+    return {"products": products, "total": total, "skip": skip, "limit": limit}, stale
+
+# Local copies of upstream reviews, so moderation can preview and redact them without DummyJSON
+REVIEW_SNAPSHOT_MEMO_SIZE = 50000
+REVIEW_SYNC_PAGE_SIZE = 100
+
+snapshotted_review_ids = set()  # ids this process has already written; avoids a write per page view
+snapshot_lock = threading.Lock()
+
+def snapshot_reviews(product, force=False):
+    """Store any reviews of a product not seen before (first sight wins, later views are free)"""
+    article_id = f"product_{product['id']}"
+    reviews = [(f"{article_id}_review_{i}", i, review) for i, review in enumerate(product.get('reviews') or [])]
+    with snapshot_lock:
+        new = [item for item in reviews if force or item[0] not in snapshotted_review_ids]
+    if not new:
+        return 0
+    now = datetime.now(timezone.utc)
+    review_snapshots_collection.bulk_write([
+        UpdateOne({"_id": review_id}, {"$setOnInsert": {
+            "article_id": article_id,
+            "review_index": index,
+            "rating": review.get('rating'),
+            "comment": review.get('comment', ''),
+            "reviewer_name": review.get('reviewerName'),
+            "reviewer_email": review.get('reviewerEmail'),
+            "date": review.get('date'),
+            "snapshotted_at": now
+        }}, upsert=True)
+        for review_id, index, review in new
+    ], ordered=False)
+    with snapshot_lock:
+        if len(snapshotted_review_ids) > REVIEW_SNAPSHOT_MEMO_SIZE:
+            snapshotted_review_ids.clear()
+        snapshotted_review_ids.update(review_id for review_id, _, _ in new)
+    return len(new)
+
+def sync_review_snapshots(page_size=REVIEW_SYNC_PAGE_SIZE):
+    """Snapshot every upstream review by paging through the catalog"""
+    skip = synced = 0
+    while True:
+        data, _, _ = fetch_upstream(f"{DUMMYJSON_BASE_URL}/products",
+                                    {'limit': page_size, 'skip': skip, 'select': 'reviews'})
+        products = data.get('products', [])
+        for product in products:
+            synced += snapshot_reviews(product, force=True)
+        skip += len(products)
+        if not products or skip >= data.get('total', 0):
+            return synced
+
+@app.cli.command('sync-review-snapshots')
+def sync_review_snapshots_command():
+    """Copy all upstream reviews into the local snapshot store"""
+    print(f"Snapshotted {sync_review_snapshots()} reviews")
+
+def get_review_redactions(id_condition):
+    """Redacted text for the matching reviews that moderators have redacted"""
+    return {
+        snapshot["_id"]: snapshot["redacted_content"]
+        for snapshot in review_snapshots_collection.find(
+            {"_id": id_condition, "redacted_content": {"$exists": True}}, {"redacted_content": 1}
+        )
+    }
+
+def apply_review_redaction(review, redactions):
+    if review['id'] in redactions:
+        review['comment'] = redactions[review['id']]
+        review['redacted'] = True
+
+def redact_reviews(review_ids, redacted_content, moderator):
+    """Redact snapshotted reviews; returns the ids that exist locally (others can't be redacted yet)"""
+    found = list(review_snapshots_collection.find({"_id": {"$in": review_ids}}, {"redacted_content": 1}))
+    if not found:
+        return set()
+    review_snapshots_collection.update_many(
+        {"_id": {"$in": [snapshot["_id"] for snapshot in found]}},
+        {"$set": {
+            "redacted_content": redacted_content,
+            "redacted_by": moderator,
+            "redacted_at": datetime.now(timezone.utc)
+        }}
+    )
+    record_moderation_totals(redacted_reviews=sum(1 for snapshot in found if 'redacted_content' not in snapshot))
+    for snapshot in found:
+        article_id = article_id_for_review(snapshot["_id"])
+        if article_id:
+            event_broker.publish(article_id, "review_redacted",
+                                 {"review_id": snapshot["_id"], "redacted_content": redacted_content})
+    return {snapshot["_id"] for snapshot in found}
+
+def content_previews(content_keys):
+    """(preview, author) for flagged comments and reviews, one query per content type"""
+    comment_ids = [ObjectId(content_id) for content_type, content_id in content_keys
+                   if content_type == 'comment' and ObjectId.is_valid(content_id)]
+    review_ids = [content_id for content_type, content_id in content_keys if content_type == 'review']
+    previews = {}
+    if comment_ids:
+        for comment in comments_collection.find({"_id": {"$in": comment_ids}}, {"content": 1, "user_name": 1}):
+            previews[('comment', str(comment["_id"]))] = (
+                make_content_preview(comment.get('content', '')), comment.get('user_name', 'Unknown')
+            )
+    if review_ids:
+        for snapshot in review_snapshots_collection.find({"_id": {"$in": review_ids}},
+                                                         {"comment": 1, "reviewer_name": 1}):
+            previews[('review', snapshot["_id"])] = (
+                make_content_preview(snapshot.get('comment', '')), snapshot.get('reviewer_name') or 'Unknown'
+            )
+    return previews
+
+# Product listing field selection (view=summary or fields=a,b,c)
+PRODUCT_SUMMARY_FIELDS = [
+    'title', 'description', 'price', 'rating', 'brand', 'thumbnail',
+    'review_count', 'average_rating', 'community_comments_count'
+]
+REVIEW_SUMMARY_FIELDS = {'review_count', 'average_rating'}
+COMMUNITY_FIELDS = {'community_comments_count'}
+
+def get_product_fields():
+    """Requested listing fields, or None for the full product"""
+    fields = request.args.get('fields')
+    if fields:
+        return [field.strip() for field in fields.split(',') if field.strip()]
+    if request.args.get('view') == 'summary':
+        return PRODUCT_SUMMARY_FIELDS
+    return None
+
+def upstream_select(fields):
+    """DummyJSON select list for the requested fields (id is always returned)"""
+    if fields is None:
+        return None
+    select = [field for field in fields if field not in REVIEW_SUMMARY_FIELDS | COMMUNITY_FIELDS]
+    if REVIEW_SUMMARY_FIELDS & set(fields) and 'reviews' not in select:
+        select.append('reviews')
+    return ','.join(select)
+
+def get_hidden_review_ids(review_ids):
+    """Which of the given reviews are hidden, in one indexed lookup"""
+    if not review_ids:
+        return set()
+    hidden_reviews = hidden_reviews_collection.find({"review_id": {"$in": review_ids}}, {"review_id": 1})
+    return {review["review_id"] for review in hidden_reviews}
+
+def count_comments_by_article(article_ids):
+    """Community comment counts for several articles in one aggregation"""
+    counts = comments_collection.aggregate([
+        {"$match": {"article_id": {"$in": article_ids}}},
+        {"$group": {"_id": "$article_id", "count": {"$sum": 1}}}
+    ])
+    return {count["_id"]: count["count"] for count in counts}
+
+def decorate_products(products, fields=None):
+    """Filter hidden reviews and add community data, skipping work for fields not returned"""
+    include_reviews = fields is None or 'reviews' in fields
+    include_review_summary = fields is None or bool(REVIEW_SUMMARY_FIELDS & set(fields))
+    include_comments = fields is None or bool(COMMUNITY_FIELDS & set(fields))
+
+    hidden_review_ids = set()
+    if include_reviews or include_review_summary:
+        hidden_review_ids = get_hidden_review_ids([
+            f"product_{product['id']}_review_{i}"
+            for product in products for i in range(len(product.get('reviews', [])))
+        ])
+    comment_counts = count_comments_by_article([f"product_{product['id']}" for product in products]) \
+        if include_comments and products else {}
+
+    redactions = {}
+    if include_reviews or include_review_summary:
+        for product in products:
+            snapshot_reviews(product)
+    if include_reviews:
+        visible_ids = [
+            f"product_{product['id']}_review_{i}"
+            for product in products for i in range(len(product.get('reviews', [])))
+        ]
+        if visible_ids:
+            redactions = get_review_redactions({"$in": visible_ids})
+
+    review_votes = {}
+    if include_reviews:
+        # Votes for every visible review on the page in one aggregation
+        review_ids = [
+            f"product_{product['id']}_review_{i}"
+            for product in products for i in range(len(product.get('reviews', [])))
+            if f"product_{product['id']}_review_{i}" not in hidden_review_ids
+        ]
+        if review_ids:
+            review_votes = votes_info_for('review', review_ids, stored_vote_counts('review', {"$in": review_ids}))
+
+    for product in products:
+        filtered_reviews = []
+        for i, review in enumerate(product.get('reviews', [])):
+            review_id = f"product_{product['id']}_review_{i}"
+            if review_id not in hidden_review_ids:
+                review['id'] = review_id
+                if include_reviews:
+                    review['votes'] = review_votes[review_id]
+                    apply_review_redaction(review, redactions)
+                filtered_reviews.append(review)
+
+        if fields is None or 'review_count' in fields:
+            product['review_count'] = len(filtered_reviews)
+        if fields is None or 'average_rating' in fields:
+            ratings = [review['rating'] for review in filtered_reviews if 'rating' in review]
+            product['average_rating'] = round(sum(ratings) / len(ratings), 2) if ratings else None
+        if include_reviews:
+            product['reviews'] = filtered_reviews
+        else:
+            product.pop('reviews', None)
+
+        if include_comments:
+            product['community_comments_count'] = comment_counts.get(f"product_{product['id']}", 0)
+    return products
 
 @app.route('/api/products')
 def get_products():
     limit = request.args.get('limit', 20)
     skip = request.args.get('skip', 0)
+    sort = request.args.get('sort')
+    fields = get_product_fields()
+
+    if sort and sort not in COMMUNITY_SORT_FIELDS:
+        return jsonify({"error": f"Invalid sort. Must be one of {', '.join(COMMUNITY_SORT_FIELDS)}"}), 400
+    if sort:
+        try:
+            data, stale = get_community_sorted_products(sort, int(limit), int(skip), fields)
+            decorate_products(data['products'], fields)
+            return upstream_response(data, 0 if stale else None)
+        except CircuitOpenError as e:
+            return circuit_open_response(e)
+        except UpstreamClientError as e:
+            return upstream_client_error_response(e)
+        except Exception as e:
+            return jsonify({"error": str(e)}), 500
     
     url = f"{DUMMYJSON_BASE_URL}/products"
     params = {
         'limit': limit,
         'skip': skip
     }
+    if fields is not None:
+        params['select'] = upstream_select(fields)
     
     try:
-        response = requests.get(url, params=params)
-        data = response.json()
+        data, _, stale_age = fetch_upstream(url, params)
 
-        hidden_reviews = list(hidden_reviews_collection.find({}, {"review_id": 1}))
-        hidden_review_ids = {review["review_id"] for review in hidden_reviews}
-
-        #For reviews
-        for product in data.get('products', []):
-            filtered_reviews = []
-            for i, review in enumerate(product.get('reviews', [])):
-                review_id = f"product_{product['id']}_review_{i}"
-                if review_id not in hidden_review_ids:
-                    review['id'] = review_id
-                    review['votes'] = get_review_votes(review_id)
-                    filtered_reviews.append(review)
-            product['reviews'] = filtered_reviews
-
-            comment_count = comments_collection.count_documents({
-                "article_id": f"product_{product['id']}"
-            })
-            print(f"DEBUG: Product {product['id']} has {comment_count} comments")
-            product['community_comments_count'] = comment_count
+        decorate_products(data.get('products', []), fields)
 
-        return jsonify(data)
+        return upstream_response(data, stale_age)
+    except CircuitOpenError as e:
+        return circuit_open_response(e)
+    except UpstreamClientError as e:
+        return upstream_client_error_response(e)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/products/<int:product_id>')
 def get_product_by_id(product_id):
     url = f"{DUMMYJSON_BASE_URL}/products/{product_id}"
+    sort = request.args.get('sort')
+
+    if sort and sort not in RANKING_SORTS:
+        return jsonify({"error": f"Invalid sort. Must be one of {', '.join(RANKING_SORTS)}"}), 400
     
     try:
-        response = requests.get(url)
-        if response.status_code == 404:
+        data, status_code, stale_age = fetch_upstream(url)
+        if status_code == 404:
             return jsonify({"error": "Product not found"}), 404
-        data = response.json()
 
+        snapshot_reviews(data)
         hidden_reviews = list(hidden_reviews_collection.find({}, {"review_id": 1}))
         hidden_review_ids = {review["review_id"] for review in hidden_reviews}
+        redactions = get_review_redactions({"$regex": f"^product_{product_id}_review_"})
 
         filtered_reviews = []
         #For reviews
@@ -189,98 +1580,230 @@ def get_product_by_id(product_id):
             if review_id not in hidden_review_ids:
                 review['id'] = review_id
                 review['votes'] = get_review_votes(review_id)
+                apply_review_redaction(review, redactions)
                 filtered_reviews.append(review)
+
+        if sort == 'new':
+            filtered_reviews.sort(key=lambda review: review.get('date', ''), reverse=True)
+        elif sort:
+            filtered_reviews = sort_by_ranking(
+                filtered_reviews, lambda review: review['id'], f"product_{product_id}", 'review', sort
+            )
         
         data['reviews'] = filtered_reviews
 
-        return jsonify(data)
+        return upstream_response(data, stale_age)
+    except CircuitOpenError as e:
+        return circuit_open_response(e)
+    except UpstreamClientError as e:
+        return upstream_client_error_response(e)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Per-product cache for multi-get; entries hold the serialized payload so readers get their own copy
+PRODUCT_CACHE_TTL_SECONDS = float(os.getenv('PRODUCT_CACHE_TTL_SECONDS', 60))
+PRODUCT_CACHE_SIZE = int(os.getenv('PRODUCT_CACHE_SIZE', 1000))
+PRODUCT_BATCH_MAX_IDS = 50
+
+product_cache = OrderedDict()  # product_id -> (expires_at, serialized product)
+product_cache_lock = threading.Lock()
+
+def get_cached_product(product_id):
+    with product_cache_lock:
+        cached = product_cache.get(product_id)
+        if cached is None:
+            return None
+        if cached[0] <= time.monotonic():
+            del product_cache[product_id]
+            return None
+        product_cache.move_to_end(product_id)
+    return app.json.loads(cached[1])
+
+def cache_product(product_id, product):
+    serialized = app.json.dumps(product)
+    with product_cache_lock:
+        product_cache[product_id] = (time.monotonic() + PRODUCT_CACHE_TTL_SECONDS, serialized)
+        product_cache.move_to_end(product_id)
+        while len(product_cache) > PRODUCT_CACHE_SIZE:
+            product_cache.popitem(last=False)
+
+def fetch_product_for_cache(product_id):
+    """Fetch one product upstream; stale fallbacks are returned but never cached"""
+    data, status_code, stale_age = fetch_upstream(f"{DUMMYJSON_BASE_URL}/products/{product_id}")
+    if status_code == 404 or data is None:
+        return None, stale_age
+    if stale_age is None:
+        cache_product(product_id, data)
+    return data, stale_age
+
+@app.route('/api/products/batch')
+def get_products_batch():
+    """Several products by id: cached ones served locally, the rest fetched concurrently"""
+    try:
+        product_ids = [int(product_id) for product_id in request.args.get('ids', '').split(',') if product_id.strip()]
+    except ValueError:
+        return jsonify({"error": "ids must be a comma-separated list of product ids"}), 400
+    product_ids = list(dict.fromkeys(product_ids))
+    if not product_ids:
+        return jsonify({"error": "ids is required"}), 400
+    if len(product_ids) > PRODUCT_BATCH_MAX_IDS:
+        return jsonify({"error": f"At most {PRODUCT_BATCH_MAX_IDS} ids per request"}), 400
+    fields = get_product_fields()
+
+    try:
+        products = {}
+        futures = {}
+        for product_id in product_ids:
+            cached = get_cached_product(product_id)
+            if cached is not None:
+                products[product_id] = cached
+            else:
+                futures[product_id] = upstream_pool.submit(fetch_product_for_cache, product_id)
+
+        stale = False
+        for product_id, future in futures.items():
+            data, stale_age = future.result()
+            if data is not None:
+                products[product_id] = data
+                stale = stale or stale_age is not None
+
+        ordered = [products[product_id] for product_id in product_ids if product_id in products]
+        decorate_products(ordered, fields)
+        if fields is not None:
+            ordered = [
+                {key: value for key, value in product.items() if key == 'id' or key in fields}
+                for product in ordered
+            ]
+        return upstream_response({
+            "products": ordered,
+            "missing": [product_id for product_id in product_ids if product_id not in products]
+        }, 0 if stale else None)
+    except CircuitOpenError as e:
+        return circuit_open_response(e)
+    except UpstreamClientError as e:
+        return upstream_client_error_response(e)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+BUNDLE_COMMENT_LIMIT = 20
+
+def load_comment_page(article_id, limit, user_email):
+    """First page of an article's comments with vote counts and the caller's own votes"""
+    comments = list(comments_collection.find({"article_id": article_id}).sort("created_at", -1).limit(limit + 1))
+    has_more = len(comments) > limit
+    comments = comments[:limit]
+    comment_ids = [str(comment["_id"]) for comment in comments]
+    votes = votes_info_for('comment', comment_ids, stored_vote_counts('comment', {"$in": comment_ids}))
+    for comment in comments:
+        comment["votes"] = votes[str(comment["_id"])]
+    user_votes = {}
+    if user_email:
+        user_votes = user_votes_for('comment', comment_ids, user_email,
+                                    stored_user_votes('comment', {"$in": comment_ids}, user_email))
+    return comments, has_more, user_votes
+
+@app.route('/api/products/<int:product_id>/bundle')
+def get_product_bundle(product_id):
+    """Everything the product page needs in one round trip, loaded concurrently"""
+    sort = request.args.get('sort')
+    if sort and sort not in RANKING_SORTS:
+        return jsonify({"error": f"Invalid sort. Must be one of {', '.join(RANKING_SORTS)}"}), 400
+    comment_limit = int_arg('comment_limit', BUNDLE_COMMENT_LIMIT, minimum=1)
+    if comment_limit is None:
+        return jsonify({"error": "comment_limit must be a positive integer"}), 400
+
+    article_id = f"product_{product_id}"
+    # Review ids are positional, so a prefix match loads every review's data before upstream answers
+    review_prefix = {"$regex": f"^{article_id}_review_"}
+    user_email = session['user'].get('email') if 'user' in session else None
+
+    try:
+        product_future = upstream_pool.submit(fetch_upstream, f"{DUMMYJSON_BASE_URL}/products/{product_id}")
+        hidden_future = upstream_pool.submit(lambda: {
+            review["review_id"] for review in hidden_reviews_collection.find({"review_id": review_prefix}, {"review_id": 1})
+        })
+        review_votes_future = upstream_pool.submit(stored_vote_counts, 'review', review_prefix)
+        redactions_future = upstream_pool.submit(get_review_redactions, review_prefix)
+        comments_future = upstream_pool.submit(load_comment_page, article_id, comment_limit, user_email)
+        ranking_future = upstream_pool.submit(ranked_content_ids, article_id, 'review', sort) \
+            if sort and sort != 'new' else None
+        user_votes_future = upstream_pool.submit(stored_user_votes, 'review', review_prefix, user_email) \
+            if user_email else None
+
+        data, status_code, stale_age = product_future.result()
+        if status_code == 404:
+            return jsonify({"error": "Product not found"}), 404
+        snapshot_reviews(data)
+
+        hidden_review_ids = hidden_future.result()
+        redactions = redactions_future.result()
+        reviews = []
+        for i, review in enumerate(data.get('reviews', [])):
+            review_id = f"{article_id}_review_{i}"
+            if review_id not in hidden_review_ids:
+                review['id'] = review_id
+                apply_review_redaction(review, redactions)
+                reviews.append(review)
+        review_ids = [review['id'] for review in reviews]
+        review_votes = votes_info_for('review', review_ids, review_votes_future.result())
+        for review in reviews:
+            review['votes'] = review_votes[review['id']]
+
+        if sort == 'new':
+            reviews.sort(key=lambda review: review.get('date', ''), reverse=True)
+        elif sort:
+            reviews = sort_by_ranking(reviews, lambda review: review['id'], article_id, 'review', sort,
+                                      ranking_future.result())
+        data['reviews'] = reviews
+
+        comments, has_more_comments, comment_user_votes = comments_future.result()
+        user_votes = {}
+        if user_email:
+            user_votes = {
+                "reviews": user_votes_for('review', review_ids, user_email, user_votes_future.result()),
+                "comments": comment_user_votes
+            }
+
+        return upstream_response({
+            "product": data,
+            "comments": comments,
+            "has_more_comments": has_more_comments,
+            "user_votes": user_votes
+        }, stale_age)
+    except CircuitOpenError as e:
+        return circuit_open_response(e)
+    except UpstreamClientError as e:
+        return upstream_client_error_response(e)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/products/search')
 def search_products():
     query = request.args.get('q', '')
+    fields = get_product_fields()
     
     url = f"{DUMMYJSON_BASE_URL}/products/search"
     params = {'q': query}
+    if fields is not None:
+        params['select'] = upstream_select(fields)
     
     try:
-        response = requests.get(url, params=params)
-        data = response.json()
-        hidden_reviews = list(hidden_reviews_collection.find({}, {"review_id": 1}))
-        hidden_review_ids = {review["review_id"] for review in hidden_reviews}
-        
-        for product in data.get('products', []):
-            filtered_reviews = []
-            for i, review in enumerate(product.get('reviews', [])):
-                review_id = f"product_{product['id']}_review_{i}"
-
-                if review_id not in hidden_review_ids:
-                    review['id'] = review_id
-                    review['votes'] = get_review_votes(review_id)
-                    filtered_reviews.append(review)
-            product['reviews'] = filtered_reviews
+        data, _, stale_age = fetch_upstream(url, params)
 
-            comment_count = comments_collection.count_documents({
-                "article_id": f"product_{product['id']}"
-            })
-            print(f"DEBUG: Product {product['id']} has {comment_count} comments")
-            product['community_comments_count'] = comment_count
+        decorate_products(data.get('products', []), fields)
         
-        return jsonify(data)
+        return upstream_response(data, stale_age)
+    except CircuitOpenError as e:
+        return circuit_open_response(e)
+    except UpstreamClientError as e:
+        return upstream_client_error_response(e)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/reviews/<review_id>/vote', methods=['POST'])
 @login_required
 def vote_review(review_id):
-    data = request.json
-    vote_type = data.get('vote_type')  # 'up' or 'down'
-    
-    if vote_type not in ['up', 'down']:
-        return jsonify({"error": "Invalid vote type. Must be 'up' or 'down'"}), 400
-    
-    user_email = session['user'].get('email')
-    
-    try:
-        existing_vote = votes_collection.find_one({
-            "review_id": review_id,
-            "user_email": user_email
-        })
-        
-        if existing_vote:
-            if existing_vote['vote_type'] == vote_type:
-                votes_collection.delete_one({"_id": existing_vote['_id']})
-                action = "removed"
-            else:
-                votes_collection.update_one(
-                    {"_id": existing_vote['_id']},
-                    {
-                        "$set": {
-                            "vote_type": vote_type,
-                            "updated_at": datetime.now(timezone.utc)
-                        }
-                    }
-                )
-                action = "updated"
-        else:
-            votes_collection.insert_one({
-                "review_id": review_id,
-                "user_email": user_email,
-                "vote_type": vote_type,
-                "created_at": datetime.now(timezone.utc)
-            })
-            action = "added"
-        votes_info = get_review_votes(review_id)
-        
-        return jsonify({
-            "success": True,
-            "action": action,
-            "votes": votes_info
-        })
-        
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+    return handle_vote('review', review_id)
 
 @app.route('/api/reviews/<review_id>/votes')
 def get_review_votes_api(review_id):
@@ -295,15 +1818,8 @@ def get_review_votes_api(review_id):
 def get_user_vote(review_id):
     try:
         user_email = session['user'].get('email')
-        user_vote = votes_collection.find_one({
-            "review_id": review_id,
-            "user_email": user_email
-        })
-        
-        if user_vote:
-            return jsonify({"vote_type": user_vote['vote_type']})
-        else:
-            return jsonify({"vote_type": None})
+        vote_type = get_user_vote_type('review', review_id, user_email)
+        return jsonify({"vote_type": vote_type})
             
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -335,6 +1851,7 @@ def flag_review(review_id):
             "created_at": datetime.now(timezone.utc),
             "resolved": False
         })
+        record_open_flags([{"reason": reason}], 1)
         
         return jsonify({"success": True, "message": "Review flagged successfully"})
         
@@ -375,42 +1892,114 @@ def flag_comment(comment_id):
             "created_at": datetime.now(timezone.utc),
             "resolved": False
         })
+        record_open_flags([{"content_type": "comment", "reason": reason}], 1)
         
         return jsonify({"success": True, "message": "Comment flagged successfully"})
         
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+def make_content_preview(content):
+    return content[:100] + '...' if len(content) > 100 else content
+
 #For moderator
 @app.route('/api/moderation/flags')
 @moderator_required
 def get_flags():
     try:
         flags = list(flags_collection.find({"resolved": False}).sort("created_at", -1))
-        
-        for flag in flags:
-            flag['_id'] = str(flag['_id'])
-            content_id = flag.get('content_id')
-            content_type = flag.get('content_type', 'review')
+        previews = content_previews({flag_key(flag) for flag in flags})
 
-            # Get content preview
-            if content_type == 'comment':
-                comment = comments_collection.find_one({"_id": ObjectId(content_id)})
-                if comment:
-                    flag['content_preview'] = comment.get('content', '')[:100] + '...' if len(comment.get('content', '')) > 100 else comment.get('content', '')
-                    flag['content_author'] = comment.get('user_name', 'Unknown')
-                else:
-                    flag['content_preview'] = 'Content not found'
-                    flag['content_author'] = 'Unknown'
-            else:
-                # For reviews, content preview would need to be fetched differently
-                flag['content_preview'] = 'Review content'
-                flag['content_author'] = 'Review author'
+        for flag in flags:
+            flag['content_preview'], flag['content_author'] = previews.get(
+                flag_key(flag), ('Content not found', 'Unknown')
+            )
         
         return jsonify(flags)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+def int_arg(name, default, minimum=0):
+    """Integer query parameter, or None when it is malformed or below minimum"""
+    try:
+        value = int(request.args.get(name, default))
+    except (TypeError, ValueError):
+        return None
+    return value if value >= minimum else None
+
+# Weights for ordering the grouped moderation queue
+FLAG_PRIORITY_COUNT_WEIGHT = 10
+FLAG_PRIORITY_REASON_WEIGHT = 5
+
+@app.route('/api/moderation/flags/grouped')
+@moderator_required
+def get_grouped_flags():
+    """Get unresolved flags grouped by content, highest priority first"""
+    limit = int_arg('limit', 20, minimum=1)
+    skip = int_arg('skip', 0)
+    if limit is None or skip is None:
+        return jsonify({"error": "limit must be a positive integer and skip a non-negative integer"}), 400
+
+    try:
+        # Review flags only store review_id, so fall back to it for the key
+        pipeline = [
+            {"$match": {"resolved": False}},
+            {"$group": {
+                "_id": {
+                    "content_type": {"$ifNull": ["$content_type", "review"]},
+                    "content_id": {"$ifNull": ["$content_id", "$review_id"]}
+                },
+                "flag_count": {"$sum": 1},
+                "reasons": {"$addToSet": "$reason"},
+                "first_flagged_at": {"$min": "$created_at"},
+                "last_flagged_at": {"$max": "$created_at"}
+            }},
+            {"$addFields": {
+                "priority": {"$add": [
+                    {"$multiply": ["$flag_count", FLAG_PRIORITY_COUNT_WEIGHT]},
+                    {"$multiply": [{"$size": "$reasons"}, FLAG_PRIORITY_REASON_WEIGHT]}
+                ]}
+            }},
+            {"$sort": {"priority": -1, "last_flagged_at": -1}},
+            {"$facet": {
+                "groups": [{"$skip": skip}, {"$limit": limit}],
+                "total": [{"$count": "count"}]
+            }}
+        ]
+        result = next(flags_collection.aggregate(pipeline), {"groups": [], "total": []})
+        groups = result["groups"]
+        total = result["total"][0]["count"] if result["total"] else 0
+
+        # One lookup per content type for everything on this page
+        previews = content_previews({(group["_id"]["content_type"], group["_id"]["content_id"]) for group in groups})
+
+        items = []
+        for group in groups:
+            content_type = group["_id"]["content_type"]
+            content_id = group["_id"]["content_id"]
+            item = {
+                "content_type": content_type,
+                "content_id": content_id,
+                "flag_count": group["flag_count"],
+                "reasons": sorted(group["reasons"]),
+                "first_flagged_at": group["first_flagged_at"],
+                "last_flagged_at": group["last_flagged_at"],
+                "priority": group["priority"]
+            }
+            item['content_preview'], item['content_author'] = previews.get(
+                (content_type, content_id), ('Content not found', 'Unknown')
+            )
+            items.append(item)
+
+        return jsonify({
+            "groups": items,
+            "total": total,
+            "limit": limit,
+            "skip": skip
+        })
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/api/moderation/flags/<flag_id>/resolve', methods=['PATCH'])
 @moderator_required
 def resolve_flag(flag_id):
@@ -425,8 +2014,7 @@ def resolve_flag(flag_id):
         if not flag:
             return jsonify({"error": "Flag not found"}), 404
         
-        content_id = flag.get('content_id')
-        content_type = flag.get('content_type', 'review')  # 'review' or 'comment'
+        content_type, content_id = flag_key(flag)  # review flags only store review_id
         
         print(f"DEBUG: content_id={content_id}, content_type={content_type}")
 
@@ -436,10 +2024,15 @@ def resolve_flag(flag_id):
             if content_type == 'comment':
                 print("DEBUG: Removing comment")
                 # Remove comment
-                comments_collection.update_one(
+                comment = comments_collection.find_one_and_update(
                     {"_id": ObjectId(content_id)},
-                    {"$set": {"is_removed": True}}
+                    {"$set": {"is_removed": True, "removed_at": datetime.now(timezone.utc)}},
+                    {"article_id": 1, "is_removed": 1}
                 )
+                if comment:
+                    publish_comment_event(content_id, "comment_removed", {}, comment['article_id'])
+                    if not comment.get('is_removed'):
+                        record_moderation_totals(removed_comments=1)
             else:
                 print(f"DEBUG: Hiding review {content_id}")
                 result = hidden_reviews_collection.insert_one({
@@ -449,6 +2042,7 @@ def resolve_flag(flag_id):
                     "reason": "moderation_action"
                 })
                 print(f"DEBUG: Insert result: {result.inserted_id}")
+                record_moderation_totals(hidden_reviews=1)
                 
         elif action == 'redact_content':
             if not redacted_content:
@@ -456,13 +2050,18 @@ def resolve_flag(flag_id):
                 
             if content_type == 'comment':
                 # Redact comment
-                comments_collection.update_one(
+                comment = comments_collection.find_one_and_update(
                     {"_id": ObjectId(content_id)},
-                    {"$set": {"redacted_content": redacted_content}}
+                    {"$set": {"redacted_content": redacted_content}},
+                    {"article_id": 1, "redacted_content": 1}
                 )
-            else:
-                # For reviews, we could store redacted version in our database
-                pass
+                if comment:
+                    publish_comment_event(content_id, "comment_redacted", {"redacted_content": redacted_content},
+                                          comment['article_id'])
+                    if not comment.get('redacted_content'):
+                        record_moderation_totals(redacted_comments=1)
+            elif not redact_reviews([content_id], redacted_content, session['user'].get('email')):
+                return jsonify({"error": "Review has not been snapshotted yet"}), 404
         
         # Mark flag as resolved with action taken
         flags_collection.update_one(
@@ -477,6 +2076,9 @@ def resolve_flag(flag_id):
                 }
             }
         )
+        if not flag.get('resolved'):
+            record_open_flags([flag], -1)
+            record_resolutions(session['user'].get('email'), action, 1)
         return jsonify({
             "success": True,
             "action_taken": action,
@@ -485,6 +2087,283 @@ def resolve_flag(flag_id):
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+MODERATION_ACTIONS = ['resolve_only', 'remove_content', 'redact_content']
+
+# Moderation dashboard counters, kept current by the moderation routes and rebuilt by reconcile
+MODERATION_STATS_TOTALS_ID = "totals"
+MODERATION_STATS_RESOLUTION_DAYS = int(os.getenv('MODERATION_STATS_RESOLUTION_DAYS', 90))
+
+def stat_key(value):
+    """Field-safe key for a reason or moderator email used inside a counter path"""
+    return str(value or 'unspecified').replace('.', '_').replace('$', '_')
+
+def update_moderation_stats(query, update):
+    # Counters are advisory: a failed write must not fail the moderation action (reconcile repairs it)
+    try:
+        moderation_stats_collection.update_one(query, update, upsert=True)
+    except Exception as e:
+        print(f"ERROR: Could not update moderation stats: {e}")
+
+def record_open_flags(flags, delta):
+    """Adjust the open flag counters for flags being opened (+1) or resolved (-1)"""
+    increments = {}
+    for flag in flags:
+        for field in ("open_flags.total",
+                      f"open_flags.by_type.{flag.get('content_type', 'review')}",
+                      f"open_flags.by_reason.{stat_key(flag.get('reason'))}"):
+            increments[field] = increments.get(field, 0) + delta
+    if increments:
+        update_moderation_stats({"_id": MODERATION_STATS_TOTALS_ID}, {"$inc": increments})
+
+def record_moderation_totals(**counts):
+    increments = {field: count for field, count in counts.items() if count}
+    if increments:
+        update_moderation_stats({"_id": MODERATION_STATS_TOTALS_ID}, {"$inc": increments})
+
+def record_resolutions(moderator, action, count):
+    if not count:
+        return
+    day = datetime.now(timezone.utc).strftime('%Y-%m-%d')
+    update_moderation_stats(
+        {"_id": f"resolutions:{day}:{moderator}"},
+        {
+            "$inc": {"count": count, f"actions.{action}": count},
+            "$setOnInsert": {"type": "resolutions", "day": day, "moderator": moderator}
+        }
+    )
+
+def reconcile_moderation_stats(days=MODERATION_STATS_RESOLUTION_DAYS):
+    """Recompute the dashboard counters from the flags, comments and hidden reviews themselves"""
+    open_flags = {"total": 0, "by_type": {}, "by_reason": {}}
+    for row in flags_collection.aggregate([
+        {"$match": {"resolved": False}},
+        {"$group": {
+            "_id": {"content_type": {"$ifNull": ["$content_type", "review"]}, "reason": "$reason"},
+            "count": {"$sum": 1}
+        }}
+    ]):
+        content_type, reason = row["_id"]["content_type"], stat_key(row["_id"].get("reason"))
+        open_flags["total"] += row["count"]
+        open_flags["by_type"][content_type] = open_flags["by_type"].get(content_type, 0) + row["count"]
+        open_flags["by_reason"][reason] = open_flags["by_reason"].get(reason, 0) + row["count"]
+
+    redacted_query = {"redacted_content": {"$exists": True, "$nin": [None, ""]}}
+    totals = {
+        "open_flags": open_flags,
+        "removed_comments": sum(collection.count_documents({"is_removed": True})
+                                for collection in (comments_collection, comments_archive_collection)),
+        "redacted_comments": sum(collection.count_documents(redacted_query)
+                                 for collection in (comments_collection, comments_archive_collection)),
+        "hidden_reviews": hidden_reviews_collection.count_documents({}),
+        "redacted_reviews": review_snapshots_collection.count_documents({"redacted_content": {"$exists": True}}),
+        "reconciled_at": datetime.now(timezone.utc)
+    }
+    moderation_stats_collection.replace_one({"_id": MODERATION_STATS_TOTALS_ID}, totals, upsert=True)
+
+    # Resolutions inside the window are rebuilt from resolved flags, including archived ones
+    since = datetime.now(timezone.utc) - timedelta(days=days)
+    resolutions = {}
+    for collection in (flags_collection, flags_archive_collection):
+        for flag in collection.find({"resolved": True, "resolved_at": {"$gte": since}},
+                                    {"resolved_at": 1, "resolved_by": 1, "action_taken": 1}):
+            day = flag["resolved_at"].strftime('%Y-%m-%d')
+            moderator = flag.get("resolved_by")
+            row = resolutions.setdefault((day, moderator), {
+                "_id": f"resolutions:{day}:{moderator}", "type": "resolutions",
+                "day": day, "moderator": moderator, "count": 0, "actions": {}
+            })
+            action = flag.get("action_taken") or 'resolve_only'
+            row["count"] += 1
+            row["actions"][action] = row["actions"].get(action, 0) + 1
+    moderation_stats_collection.delete_many({"type": "resolutions", "day": {"$gte": since.strftime('%Y-%m-%d')}})
+    if resolutions:
+        moderation_stats_collection.insert_many(list(resolutions.values()))
+    return {"open_flags": open_flags["total"], "resolution_rows": len(resolutions)}
+
+@app.cli.command('reconcile-moderation-stats')
+def reconcile_moderation_stats_command():
+    """Rebuild the moderation dashboard counters (run from cron)"""
+    print(reconcile_moderation_stats())
+
+@app.route('/api/moderation/stats')
+@moderator_required
+def get_moderation_stats():
+    """Dashboard overview read from the maintained counters"""
+    days = int_arg('days', 7, minimum=1)
+    if days is None:
+        return jsonify({"error": "days must be a positive integer"}), 400
+    try:
+        totals = moderation_stats_collection.find_one({"_id": MODERATION_STATS_TOTALS_ID}) or {}
+        since = (datetime.now(timezone.utc) - timedelta(days=days - 1)).strftime('%Y-%m-%d')
+        resolutions = list(moderation_stats_collection.find(
+            {"type": "resolutions", "day": {"$gte": since}},
+            {"_id": 0, "day": 1, "moderator": 1, "count": 1, "actions": 1}
+        ).sort([("day", -1), ("moderator", 1)]))
+        return jsonify({
+            "open_flags": totals.get("open_flags", {"total": 0, "by_type": {}, "by_reason": {}}),
+            "removed_comments": totals.get("removed_comments", 0),
+            "redacted_comments": totals.get("redacted_comments", 0),
+            "hidden_reviews": totals.get("hidden_reviews", 0),
+            "redacted_reviews": totals.get("redacted_reviews", 0),
+            "resolutions": resolutions,
+            "reconciled_at": totals.get("reconciled_at")
+        })
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+MAX_BULK_RESOLVE_ITEMS = 500
+
+def flag_key(flag):
+    """(content_type, content_id) for a flag; review flags only store review_id"""
+    return (flag.get('content_type', 'review'), flag.get('content_id') or flag.get('review_id'))
+
+def flags_filter_for_content(content_keys):
+    """Filter matching unresolved flags on any of the given (content_type, content_id) keys"""
+    clauses = []
+    review_ids = [content_id for content_type, content_id in content_keys if content_type == 'review']
+    if review_ids:
+        clauses.append({"review_id": {"$in": review_ids}})
+        clauses.append({"content_type": "review", "content_id": {"$in": review_ids}})
+    for content_type in {content_type for content_type, _ in content_keys if content_type != 'review'}:
+        clauses.append({
+            "content_type": content_type,
+            "content_id": {"$in": [content_id for key_type, content_id in content_keys if key_type == content_type]}
+        })
+    return {"resolved": False, "$or": clauses}
+
+@app.route('/api/moderation/flags/bulk-resolve', methods=['POST'])
+@moderator_required
+def bulk_resolve_flags():
+    """Resolve every open flag on the selected content with one action per content item"""
+    data = request.json or {}
+    action = data.get('action', 'resolve_only')
+    redacted_content = data.get('redacted_content', '')
+    flag_ids = data.get('flag_ids', [])
+    content_items = data.get('content', [])
+
+    if action not in MODERATION_ACTIONS:
+        return jsonify({"error": f"Invalid action. Must be one of {', '.join(MODERATION_ACTIONS)}"}), 400
+    if action == 'redact_content' and not redacted_content:
+        return jsonify({"error": "Redacted content is required for redact action"}), 400
+    if not flag_ids and not content_items:
+        return jsonify({"error": "flag_ids or content is required"}), 400
+    if len(flag_ids) + len(content_items) > MAX_BULK_RESOLVE_ITEMS:
+        return jsonify({"error": f"At most {MAX_BULK_RESOLVE_ITEMS} items can be resolved at once"}), 400
+
+    try:
+        # Resolve flag ids to the content they point at, keeping request order
+        content_keys = []
+        for item in content_items:
+            key = (item.get('content_type', 'review'), item.get('content_id'))
+            if key[1] and key not in content_keys:
+                content_keys.append(key)
+
+        unknown_flag_ids = [flag_id for flag_id in flag_ids if not ObjectId.is_valid(flag_id)]
+        valid_flag_ids = [ObjectId(flag_id) for flag_id in flag_ids if ObjectId.is_valid(flag_id)]
+        if valid_flag_ids:
+            found = list(flags_collection.find(
+                {"_id": {"$in": valid_flag_ids}},
+                {"content_id": 1, "content_type": 1, "review_id": 1}
+            ))
+            found_ids = {str(flag['_id']) for flag in found}
+            unknown_flag_ids += [str(flag_id) for flag_id in valid_flag_ids if str(flag_id) not in found_ids]
+            for flag in found:
+                key = flag_key(flag)
+                if key not in content_keys:
+                    content_keys.append(key)
+
+        if not content_keys:
+            return jsonify({"error": "No matching flags found", "unknown_flag_ids": unknown_flag_ids}), 404
+
+        moderator_email = session['user'].get('email')
+        now = datetime.now(timezone.utc)
+        content_updated = {key: False for key in content_keys}
+
+        # Apply the action once per content item
+        comment_ids = [ObjectId(content_id) for content_type, content_id in content_keys
+                       if content_type == 'comment' and ObjectId.is_valid(content_id)]
+        review_ids = [content_id for content_type, content_id in content_keys if content_type == 'review']
+
+        if action == 'remove_content':
+            if comment_ids:
+                found = list(comments_collection.find({"_id": {"$in": comment_ids}}, {"article_id": 1, "is_removed": 1}))
+                existing = {str(c['_id']): c['article_id'] for c in found}
+                comments_collection.update_many({"_id": {"$in": comment_ids}}, {"$set": {"is_removed": True, "removed_at": datetime.now(timezone.utc)}})
+                record_moderation_totals(removed_comments=sum(1 for c in found if not c.get('is_removed')))
+                for content_id, article_id in existing.items():
+                    content_updated[('comment', content_id)] = True
+                    publish_comment_event(content_id, "comment_removed", {}, article_id)
+            if review_ids:
+                already_hidden = {
+                    review['review_id'] for review in
+                    hidden_reviews_collection.find({"review_id": {"$in": review_ids}}, {"review_id": 1})
+                }
+                to_hide = [review_id for review_id in review_ids if review_id not in already_hidden]
+                if to_hide:
+                    hidden_reviews_collection.insert_many([{
+                        "review_id": review_id,
+                        "hidden_by": moderator_email,
+                        "hidden_at": now,
+                        "reason": "moderation_action"
+                    } for review_id in to_hide])
+                    record_moderation_totals(hidden_reviews=len(to_hide))
+                for review_id in review_ids:
+                    content_updated[('review', review_id)] = True
+        elif action == 'redact_content':
+            for review_id in redact_reviews(review_ids, redacted_content, moderator_email) if review_ids else ():
+                content_updated[('review', review_id)] = True
+        if action == 'redact_content' and comment_ids:
+            found = list(comments_collection.find({"_id": {"$in": comment_ids}}, {"article_id": 1, "redacted_content": 1}))
+            existing = {str(c['_id']): c['article_id'] for c in found}
+            comments_collection.update_many(
+                {"_id": {"$in": comment_ids}},
+                {"$set": {"redacted_content": redacted_content}}
+            )
+            record_moderation_totals(redacted_comments=sum(1 for c in found if not c.get('redacted_content')))
+            for content_id, article_id in existing.items():
+                content_updated[('comment', content_id)] = True
+                publish_comment_event(content_id, "comment_redacted", {"redacted_content": redacted_content}, article_id)
+
+        # Close every open flag on the selected content in one write
+        open_flags = list(flags_collection.find(
+            flags_filter_for_content(content_keys),
+            {"content_id": 1, "content_type": 1, "review_id": 1, "reason": 1}
+        ))
+        flags_resolved = {key: 0 for key in content_keys}
+        for flag in open_flags:
+            key = flag_key(flag)
+            if key in flags_resolved:
+                flags_resolved[key] += 1
+        if open_flags:
+            flags_collection.update_many(
+                {"_id": {"$in": [flag['_id'] for flag in open_flags]}},
+                {"$set": {
+                    "resolved": True,
+                    "resolved_at": now,
+                    "resolved_by": moderator_email,
+                    "action_taken": action,
+                    "redacted_content": redacted_content if action == 'redact_content' else None
+                }}
+            )
+            record_open_flags(open_flags, -1)
+            record_resolutions(moderator_email, action, len(open_flags))
+
+        results = [{
+            "content_type": content_type,
+            "content_id": content_id,
+            "flags_resolved": flags_resolved[(content_type, content_id)],
+            "content_updated": content_updated[(content_type, content_id)]
+        } for content_type, content_id in content_keys]
+
+        return jsonify({
+            "success": True,
+            "action_taken": action,
+            "results": results,
+            "flags_resolved": len(open_flags),
+            "unknown_flag_ids": unknown_flag_ids
+        })
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/api/moderation/content/<content_type>/<content_id>')
 @moderator_required
 def get_content_for_moderation(content_type, content_id):
@@ -493,35 +2372,329 @@ def get_content_for_moderation(content_type, content_id):
         if content_type == 'comment':
             content = comments_collection.find_one({"_id": ObjectId(content_id)})
             if content:
-                content['_id'] = str(content['_id'])
                 return jsonify(content)
         elif content_type == 'review':
-            # For reviews, we'd need to fetch from our stored data or DummyJSON
-            return jsonify({"error": "Review content retrieval not implemented"}), 501
+            snapshot = review_snapshots_collection.find_one({"_id": content_id})
+            if snapshot:
+                snapshot['is_hidden'] = hidden_reviews_collection.find_one({"review_id": content_id}) is not None
+                return jsonify(snapshot)
         
         return jsonify({"error": "Content not found"}), 404
         
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+# Moderator exports (streamed from the cursor, resumable by _id)
+EXPORT_BATCH_SIZE = 1000
+EXPORT_COLUMNS = {
+    'comments': ['_id', 'article_id', 'parent_id', 'user_email', 'user_name', 'content',
+                 'redacted_content', 'is_removed', 'created_at'],
+    'votes': ['_id', 'content_type', 'content_id', 'user_email', 'vote_type', 'created_at', 'updated_at'],
+    'flags': ['_id', 'review_id', 'content_type', 'content_id', 'user_email', 'reason', 'resolved',
+              'resolved_by', 'action_taken', 'created_at', 'resolved_at']
+}
+
+def export_collection(name):
+    return {'comments': comments_collection, 'votes': votes_collection, 'flags': flags_collection}[name]
+
+def export_value(value):
+    return json_default(value) if isinstance(value, (ObjectId, datetime)) else value
+
+def build_export_filter(name, args):
+    """Mongo filter for an export; raises ValueError on bad parameters"""
+    query = {}
+    article_id = args.get('article_id')
+    if article_id:
+        # Reviews are keyed by their product, so a prefix match stays on the index
+        review_prefix = {"$regex": f"^{re.escape(article_id)}_review_"}
+        if name == 'comments':
+            query['article_id'] = article_id
+        else:
+            comment_ids = [str(comment["_id"]) for comment in
+                           comments_collection.find({"article_id": article_id}, {"_id": 1})]
+            comment_match = {"content_type": "comment", "content_id": {"$in": comment_ids}}
+            if name == 'votes':
+                query['$or'] = [{"content_type": "review", "content_id": review_prefix}, comment_match]
+            else:
+                query['$or'] = [{"review_id": review_prefix}, comment_match]
+
+    created_at = {}
+    if args.get('from'):
+        created_at['$gte'] = datetime.fromisoformat(args['from'])
+    if args.get('to'):
+        created_at['$lt'] = datetime.fromisoformat(args['to'])
+    if created_at:
+        query['created_at'] = created_at
+
+    resolved = args.get('resolved')
+    if resolved is not None and name == 'flags':
+        if resolved not in ('true', 'false'):
+            raise ValueError("resolved must be 'true' or 'false'")
+        query['resolved'] = resolved == 'true'
+
+    after = args.get('after')
+    if after:
+        if not ObjectId.is_valid(after):
+            raise ValueError("after must be a valid id")
+        query['_id'] = {"$gt": ObjectId(after)}
+    return query
+
+def generate_export_rows(cursor, name, export_format):
+    columns = EXPORT_COLUMNS[name]
+    if export_format == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+        for doc in cursor:
+            writer.writerow([export_value(doc.get(column)) for column in columns])
+            if buffer.tell() > 64 * 1024:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+    else:
+        for doc in cursor:
+            yield app.json.dumps(doc) + "\n"
+
+@app.route('/api/moderation/export/<name>')
+@moderator_required
+def export_moderation_data(name):
+    """Stream comments, votes or flags as NDJSON or CSV; resume with ?after=<last _id>"""
+    if name not in EXPORT_COLUMNS:
+        return jsonify({"error": f"Unknown export. Must be one of {', '.join(EXPORT_COLUMNS)}"}), 404
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in ('ndjson', 'csv'):
+        return jsonify({"error": "Format must be 'ndjson' or 'csv'"}), 400
+
+    try:
+        query = build_export_filter(name, request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    try:
+        cursor = export_collection(name).find(query).sort("_id", 1).batch_size(EXPORT_BATCH_SIZE)
+        mimetype = 'text/csv' if export_format == 'csv' else 'application/x-ndjson'
+        extension = 'csv' if export_format == 'csv' else 'ndjson'
+        return Response(generate_export_rows(cursor, name, export_format), mimetype=mimetype, headers={
+            "Content-Disposition": f"attachment; filename={name}.{extension}"
+        })
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# Archival of resolved flags and removed comments
+def move_documents(source, target, query, batch_size=ARCHIVE_BATCH_SIZE, archive=True):
+    """Move matching documents between collections in batches; safe to re-run after a failure"""
+    moved = 0
+    while True:
+        batch = list(source.find(query).limit(batch_size))
+        if not batch:
+            return moved
+        now = datetime.now(timezone.utc)
+        for doc in batch:
+            if archive:
+                doc['archived_at'] = now
+            else:
+                doc.pop('archived_at', None)
+        # Upsert by _id so a batch interrupted before the delete is not duplicated
+        target.bulk_write([ReplaceOne({"_id": doc["_id"]}, doc, upsert=True) for doc in batch], ordered=False)
+        source.delete_many({"_id": {"$in": [doc["_id"] for doc in batch]}})
+        moved += len(batch)
+        if len(batch) < batch_size:
+            return moved
+
+def run_archival(flags_after_days=ARCHIVE_RESOLVED_FLAGS_AFTER_DAYS,
+                 comments_after_days=ARCHIVE_REMOVED_COMMENTS_AFTER_DAYS, batch_size=ARCHIVE_BATCH_SIZE):
+    """Move old resolved flags and removed comments (with their votes) into archive collections"""
+    now = datetime.now(timezone.utc)
+    flags_cutoff = now - timedelta(days=flags_after_days)
+    comments_cutoff = now - timedelta(days=comments_after_days)
+
+    flags_moved = move_documents(
+        flags_collection, flags_archive_collection,
+        {"resolved": True, "resolved_at": {"$lt": flags_cutoff}}, batch_size
+    )
+
+    # Comments removed before removed_at was recorded fall back to created_at
+    removed_query = {"is_removed": True, "$or": [
+        {"removed_at": {"$lt": comments_cutoff}},
+        {"removed_at": {"$exists": False}, "created_at": {"$lt": comments_cutoff}}
+    ]}
+    comments_moved = votes_moved = 0
+    while True:
+        comment_ids = [comment["_id"] for comment in comments_collection.find(removed_query, {"_id": 1}).limit(batch_size)]
+        if not comment_ids:
+            break
+        votes_moved += move_documents(
+            votes_collection, votes_archive_collection,
+            {"content_type": "comment", "content_id": {"$in": [str(comment_id) for comment_id in comment_ids]}},
+            batch_size
+        )
+        comments_moved += move_documents(
+            comments_collection, comments_archive_collection, {"_id": {"$in": comment_ids}}, batch_size
+        )
+
+    return {"flags": flags_moved, "comments": comments_moved, "votes": votes_moved}
+
+def restore_archived(kind, ids):
+    """Move archived flags or comments (and the comments' votes) back into the hot collections"""
+    object_ids = [ObjectId(doc_id) for doc_id in ids if ObjectId.is_valid(doc_id)]
+    if kind == 'flags':
+        return {"flags": move_documents(flags_archive_collection, flags_collection,
+                                        {"_id": {"$in": object_ids}}, archive=False)}
+    votes_restored = move_documents(
+        votes_archive_collection, votes_collection,
+        {"content_type": "comment", "content_id": {"$in": [str(doc_id) for doc_id in object_ids]}},
+        archive=False
+    )
+    comments_restored = move_documents(comments_archive_collection, comments_collection,
+                                       {"_id": {"$in": object_ids}}, archive=False)
+    return {"comments": comments_restored, "votes": votes_restored}
+
+@app.route('/api/moderation/archive/run', methods=['POST'])
+@moderator_required
+def run_archival_api():
+    """Archive resolved flags and removed comments older than the retention window"""
+    data = request.json or {}
+    try:
+        moved = run_archival(
+            int(data.get('flags_after_days', ARCHIVE_RESOLVED_FLAGS_AFTER_DAYS)),
+            int(data.get('comments_after_days', ARCHIVE_REMOVED_COMMENTS_AFTER_DAYS))
+        )
+        return jsonify({"success": True, "archived": moved})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/moderation/archive/restore', methods=['POST'])
+@moderator_required
+def restore_archived_api():
+    """Restore archived flags or comments by id"""
+    data = request.json or {}
+    kind = data.get('collection')
+    ids = data.get('ids', [])
+
+    if kind not in ('flags', 'comments'):
+        return jsonify({"error": "Collection must be 'flags' or 'comments'"}), 400
+    if not ids:
+        return jsonify({"error": "ids are required"}), 400
+
+    try:
+        return jsonify({"success": True, "restored": restore_archived(kind, ids)})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.cli.command('archive')
+def archive_command():
+    """Archive resolved flags and removed comments (run from cron)"""
+    print(run_archival())
+
+@app.route('/api/moderation/slow-queries')
+@moderator_required
+def get_slow_queries():
+    """Slowest query shapes by total time, with the routes that issued them"""
+    limit = int_arg('limit', 20, minimum=1)
+    if limit is None:
+        return jsonify({"error": "limit must be a positive integer"}), 400
+    return jsonify({
+        "threshold_ms": query_profiler.threshold_ms,
+        "queries": query_profiler.report(limit)
+    })
+
 # Comment/Review system
 @app.route('/api/comments', methods=['GET'])
 def get_comments():
     """Get comments for a specific product"""
     article_id = request.args.get('article_id')
+    sort = request.args.get('sort', 'new')
     
     if not article_id:
         return jsonify({"error": "Article ID is required"}), 400
+    if sort not in RANKING_SORTS:
+        return jsonify({"error": f"Invalid sort. Must be one of {', '.join(RANKING_SORTS)}"}), 400
         
     try:
         comments = list(comments_collection.find({"article_id": article_id}).sort("created_at", -1))
-        
-        for comment in comments:
-            comment['_id'] = str(comment['_id'])
+
+        if sort != 'new':
+            comments = sort_by_ranking(comments, lambda comment: str(comment['_id']), article_id, 'comment', sort)
         return jsonify(comments)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+COMMENT_SEARCH_MAX_LIMIT = 100
+
+def parse_search_cursor(cursor):
+    """Keyset cursor '<score>:<id>' from the previous page's last result"""
+    score, _, comment_id = cursor.partition(':')
+    if not ObjectId.is_valid(comment_id):
+        raise ValueError("Invalid cursor")
+    return float(score), ObjectId(comment_id)
+
+def build_comment_search_pipeline(query, filters, moderator, cursor, limit):
+    """Text search ordered by relevance, then newest id, so pages never repeat or skip"""
+    match = dict(filters, **{"$text": {"$search": query}})
+    if not moderator:
+        match["is_removed"] = {"$ne": True}
+    pipeline = [{"$match": match}, {"$addFields": {"score": {"$meta": "textScore"}}}]
+    if not moderator:
+        # A redacted comment may only match on the text readers can still see
+        terms = [re.escape(term) for term in re.findall(r'\w+', query)]
+        pipeline.append({"$match": {"$or": [
+            {"redacted_content": {"$exists": False}},
+            {"redacted_content": {"$regex": '|'.join(terms) or '$^', "$options": "i"}}
+        ]}})
+    if cursor:
+        score, last_id = cursor
+        pipeline.append({"$match": {"$or": [
+            {"score": {"$lt": score}},
+            {"score": score, "_id": {"$lt": last_id}}
+        ]}})
+    pipeline += [{"$sort": {"score": -1, "_id": -1}}, {"$limit": limit + 1}]
+    return pipeline
+
+@app.route('/api/comments/search')
+def search_comments():
+    """Full-text comment search with article/author/date filters and keyset pagination"""
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({"error": "q is required"}), 400
+    limit = int_arg('limit', 20, minimum=1)
+    if limit is None:
+        return jsonify({"error": "limit must be a positive integer"}), 400
+    limit = min(limit, COMMENT_SEARCH_MAX_LIMIT)
+
+    filters = {}
+    if request.args.get('article_id'):
+        filters['article_id'] = request.args['article_id']
+    if request.args.get('author'):
+        filters['user_email'] = request.args['author']
+    try:
+        created_at = {}
+        if request.args.get('from'):
+            created_at['$gte'] = datetime.fromisoformat(request.args['from'])
+        if request.args.get('to'):
+            created_at['$lt'] = datetime.fromisoformat(request.args['to'])
+        if created_at:
+            filters['created_at'] = created_at
+        cursor = parse_search_cursor(request.args['cursor']) if request.args.get('cursor') else None
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    moderator = is_moderator()
+    try:
+        pipeline = build_comment_search_pipeline(query, filters, moderator, cursor, limit)
+        results = list(comments_collection.aggregate(pipeline))
+        next_cursor = None
+        if len(results) > limit:
+            results = results[:limit]
+            next_cursor = f"{results[-1]['score']}:{results[-1]['_id']}"
+        if not moderator:
+            for comment in results:
+                if 'redacted_content' in comment:
+                    comment['content'] = comment.pop('redacted_content')
+        return jsonify({"results": results, "next_cursor": next_cursor})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/api/comments', methods=['POST'])
 @login_required
 def add_comment():
@@ -554,6 +2727,8 @@ def add_comment():
             
         result = comments_collection.insert_one(comment)
         comment["_id"] = str(result.inserted_id)
+        record_engagement(article_id, comments=1, activity=TRENDING_COMMENT_WEIGHT)
+        event_broker.publish(article_id, "comment_created", comment)
         
         return jsonify(comment), 201
     except Exception as e:
@@ -571,13 +2746,33 @@ def remove_comment(comment_id):
             
         comments_collection.update_one(
             {"_id": ObjectId(comment_id)},
-            {"$set": {"is_removed": True}}
+            {"$set": {"is_removed": True, "removed_at": datetime.now(timezone.utc)}}
         )
+        publish_comment_event(comment_id, "comment_removed", {}, comment['article_id'])
+        if not comment.get('is_removed'):
+            record_moderation_totals(removed_comments=1)
         
         return jsonify({"success": True})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/reviews/<review_id>/redact', methods=['PATCH'])
+@moderator_required
+def redact_review(review_id):
+    """Redact a review's text in the local snapshot (moderator only)"""
+    data = request.json or {}
+    redacted_content = data.get('redacted_content')
+
+    if not redacted_content:
+        return jsonify({"error": "Redacted content is required"}), 400
+
+    try:
+        if not redact_reviews([review_id], redacted_content, session['user'].get('email')):
+            return jsonify({"error": "Review not found"}), 404
+        return jsonify({"success": True})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/api/comments/<comment_id>/redact', methods=['PATCH'])
 @moderator_required
 def redact_comment(comment_id):
@@ -598,6 +2793,9 @@ def redact_comment(comment_id):
             {"_id": ObjectId(comment_id)},
             {"$set": {"redacted_content": redacted_content}}
         )
+        publish_comment_event(comment_id, "comment_redacted", {"redacted_content": redacted_content}, comment['article_id'])
+        if not comment.get('redacted_content'):
+            record_moderation_totals(redacted_comments=1)
         
         return jsonify({"success": True})
     except Exception as e:
@@ -608,95 +2806,13 @@ def redact_comment(comment_id):
 @login_required
 def vote_comment(comment_id):
     """Vote on a comment"""
-    data = request.json
-    vote_type = data.get('vote_type')  # 'up' or 'down'
-    
-    if vote_type not in ['up', 'down']:
-        return jsonify({"error": "Invalid vote type. Must be 'up' or 'down'"}), 400
-    
-    user_email = session['user'].get('email')
-    
-    try:
-        # Check existing vote
-        existing_vote = votes_collection.find_one({
-            "content_id": comment_id,
-            "content_type": "comment",
-            "user_email": user_email
-        })
-        
-        if existing_vote:
-            if existing_vote['vote_type'] == vote_type:
-                # Remove vote
-                votes_collection.delete_one({"_id": existing_vote['_id']})
-                action = "removed"
-            else:
-                # Update vote
-                votes_collection.update_one(
-                    {"_id": existing_vote['_id']},
-                    {
-                        "$set": {
-                            "vote_type": vote_type,
-                            "updated_at": datetime.now(timezone.utc)
-                        }
-                    }
-                )
-                action = "updated"
-        else:
-            # New vote
-            votes_collection.insert_one({
-                "content_id": comment_id,
-                "content_type": "comment",
-                "user_email": user_email,
-                "vote_type": vote_type,
-                "created_at": datetime.now(timezone.utc)
-            })
-            action = "added"
-        
-        # Get updated vote counts
-        upvotes = votes_collection.count_documents({
-            "content_id": comment_id, 
-            "content_type": "comment",
-            "vote_type": "up"
-        })
-        downvotes = votes_collection.count_documents({
-            "content_id": comment_id,
-            "content_type": "comment", 
-            "vote_type": "down"
-        })
-        
-        return jsonify({
-            "success": True,
-            "action": action,
-            "votes": {
-                "upvotes": upvotes,
-                "downvotes": downvotes,
-                "score": upvotes - downvotes
-            }
-        })
-        
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+    return handle_vote('comment', comment_id)
 
 @app.route('/api/comments/<comment_id>/votes')
 def get_comment_votes(comment_id):
     """Get comment vote counts"""
     try:
-        upvotes = votes_collection.count_documents({
-            "content_id": comment_id,
-            "content_type": "comment",
-            "vote_type": "up"
-        })
-        downvotes = votes_collection.count_documents({
-            "content_id": comment_id,
-            "content_type": "comment",
-            "vote_type": "down"
-        })
-        
-        return jsonify({
-            "upvotes": upvotes,
-            "downvotes": downvotes,
-            "score": upvotes - downvotes
-        })
+        return jsonify(count_votes('comment', comment_id))
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -706,16 +2822,8 @@ def get_user_comment_vote(comment_id):
     """Get user's vote on comment"""
     try:
         user_email = session['user'].get('email')
-        user_vote = votes_collection.find_one({
-            "content_id": comment_id,
-            "content_type": "comment",
-            "user_email": user_email
-        })
-        
-        if user_vote:
-            return jsonify({"vote_type": user_vote['vote_type']})
-        else:
-            return jsonify({"vote_type": None})
+        vote_type = get_user_vote_type('comment', comment_id, user_email)
+        return jsonify({"vote_type": vote_type})
             
     except Exception as e:
         return jsonify({"error": str(e)}), 500
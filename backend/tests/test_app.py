@@ -3,11 +3,13 @@ import os
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 import pytest 
 from app import app
+import app as app_module
 from unittest.mock import patch, MagicMock
 import mongomock
 from bson import ObjectId
-from datetime import datetime, timezone
+from datetime import datetime, timezone, timedelta
 import json
+import time
 from flask import Response
 
 # Setup Fixture
@@ -15,10 +17,28 @@ from flask import Response
 @pytest.fixture
 def client(monkeypatch):
     mock_client = mongomock.MongoClient()
-    mock_collection = mock_client.mydatabase.comments
-
-    # Patch the global comments_collection in app.py
-    monkeypatch.setattr("app.comments_collection", mock_collection)
+    mock_db = mock_client.mydatabase
+
+    # Patch the global collections in app.py
+    monkeypatch.setattr("app.comments_collection", mock_db.comments)
+    monkeypatch.setattr("app.votes_collection", mock_db.votes)
+    monkeypatch.setattr("app.flags_collection", mock_db.flags)
+    monkeypatch.setattr("app.hidden_reviews_collection", mock_db.hidden_reviews)
+    monkeypatch.setattr("app.rankings_collection", mock_db.content_rankings)
+    monkeypatch.setattr("app.engagement_collection", mock_db.product_engagement)
+    monkeypatch.setattr("app.moderation_stats_collection", mock_db.moderation_stats)
+    monkeypatch.setattr("app.flags_archive_collection", mock_db.flags_archive)
+    monkeypatch.setattr("app.comments_archive_collection", mock_db.comments_archive)
+    monkeypatch.setattr("app.votes_archive_collection", mock_db.votes_archive)
+    monkeypatch.setattr("app.database_ready", False)
+    monkeypatch.setattr("app.review_votes_migrated", False)
+    monkeypatch.setattr("app.oauth_client", None)
+    monkeypatch.setattr("app.upstream_breaker", app_module.CircuitBreaker())
+    monkeypatch.setattr("app.upstream_stale_cache", app_module.OrderedDict())
+    monkeypatch.setattr("app.product_cache", app_module.OrderedDict())
+    monkeypatch.setattr("app.query_profiler", app_module.QueryProfiler())
+    monkeypatch.setattr("app.event_broker", app_module.EventBroker())
+    monkeypatch.setattr("app.vote_buffer", app_module.VoteBuffer(enabled=False))
 
     app.config['TESTING'] = True
     with app.test_client() as client:
@@ -682,6 +702,53 @@ def test_resolve_flag_not_found(client):
     })
     assert response.status_code == 404
 
+# Comment search tests
+def test_comment_search_pipeline_for_readers():
+    last_id = ObjectId()
+    pipeline = app_module.build_comment_search_pipeline(
+        "scam link", {"article_id": "product_1"}, False, (1.5, last_id), 10
+    )
+    assert pipeline[0]["$match"] == {
+        "article_id": "product_1", "$text": {"$search": "scam link"}, "is_removed": {"$ne": True}
+    }
+    assert pipeline[1] == {"$addFields": {"score": {"$meta": "textScore"}}}
+    redacted = pipeline[2]["$match"]["$or"][1]["redacted_content"]
+    assert redacted == {"$regex": "scam|link", "$options": "i"}
+    assert pipeline[3]["$match"]["$or"][1] == {"score": 1.5, "_id": {"$lt": last_id}}
+    assert pipeline[-2:] == [{"$sort": {"score": -1, "_id": -1}}, {"$limit": 11}]
+
+def test_comment_search_pipeline_for_moderators():
+    pipeline = app_module.build_comment_search_pipeline("scam", {}, True, None, 5)
+    assert "is_removed" not in pipeline[0]["$match"]
+    assert len(pipeline) == 4
+
+def test_search_comments_pages_with_cursor(client):
+    ids = [ObjectId() for _ in range(3)]
+    rows = [
+        {"_id": ids[0], "content": "scam here", "score": 2.0},
+        {"_id": ids[1], "content": "original scam", "redacted_content": "████ scam", "score": 1.5},
+        {"_id": ids[2], "content": "scam again", "score": 1.0}
+    ]
+    with patch.object(app_module.comments_collection, "aggregate", return_value=iter(rows)) as aggregate:
+        data = client.get("/api/comments/search?q=scam&limit=2&author=a@hw3.com&from=2024-01-01").get_json()
+    match = aggregate.call_args.args[0][0]["$match"]
+    assert match["user_email"] == "a@hw3.com"
+    assert match["created_at"]["$gte"] == datetime(2024, 1, 1)
+    assert [result["content"] for result in data["results"]] == ["scam here", "████ scam"]
+    assert "redacted_content" not in data["results"][1]
+    assert data["next_cursor"] == f"1.5:{ids[1]}"
+
+    with patch.object(app_module.comments_collection, "aggregate", return_value=iter([])) as aggregate:
+        data = client.get(f"/api/comments/search?q=scam&cursor={data['next_cursor']}").get_json()
+    assert data == {"results": [], "next_cursor": None}
+    assert aggregate.call_args.args[0][3]["$match"]["$or"][0] == {"score": {"$lt": 1.5}}
+
+def test_search_comments_validation(client):
+    assert client.get("/api/comments/search").status_code == 400
+    assert client.get("/api/comments/search?q=x&cursor=bad").status_code == 400
+    assert client.get("/api/comments/search?q=x&from=yesterday").status_code == 400
+    assert client.get("/api/comments/search?q=x&limit=0").status_code == 400
+
 # Comment voting tests
 def test_vote_comment_success(client):
     login_session(client)
@@ -788,4 +855,1000 @@ def test_get_products_with_params(client):
         mock_get.assert_called_once()
         args, kwargs = mock_get.call_args
         assert kwargs['params']['limit'] == '10'
-        assert kwargs['params']['skip'] == '5'
\ No newline at end of file
+        assert kwargs['params']['skip'] == '5'
+# Grouped moderation queue tests
+def test_get_grouped_flags_groups_by_content(client):
+    login_session(client)
+    comment_response = client.post('/api/comments', json={
+        "article_id": "test-article",
+        "content": "Brigaded comment"
+    })
+    comment_id = comment_response.get_json()['_id']
+
+    for i, reason in enumerate(["Spam", "Spam", "Abuse"]):
+        login_session(client, email=f"user{i}@hw3.com")
+        client.post(f"/api/comments/{comment_id}/flag", json={"reason": reason})
+    client.post("/api/reviews/product_1_review_0/flag", json={"reason": "Spam"})
+
+    login_session(client, email="moderator@hw3.com")
+    response = client.get("/api/moderation/flags/grouped")
+    assert response.status_code == 200
+    data = response.get_json()
+    assert data["total"] == 2
+    top = data["groups"][0]
+    assert top["content_type"] == "comment"
+    assert top["content_id"] == comment_id
+    assert top["flag_count"] == 3
+    assert top["reasons"] == ["Abuse", "Spam"]
+    assert top["content_preview"] == "Brigaded comment"
+    assert data["groups"][1]["content_id"] == "product_1_review_0"
+
+def test_get_grouped_flags_pagination(client):
+    login_session(client)
+    for i in range(3):
+        client.post(f"/api/reviews/product_1_review_{i}/flag", json={"reason": "Spam"})
+
+    login_session(client, email="moderator@hw3.com")
+    response = client.get("/api/moderation/flags/grouped?limit=2&skip=2")
+    data = response.get_json()
+    assert data["total"] == 3
+    assert len(data["groups"]) == 1
+
+def test_get_grouped_flags_invalid_pagination(client):
+    login_session(client, email="moderator@hw3.com")
+    for query in ("limit=abc", "limit=0", "skip=-1"):
+        assert client.get(f"/api/moderation/flags/grouped?{query}").status_code == 400
+
+def test_get_grouped_flags_non_moderator(client):
+    login_session(client)
+    response = client.get("/api/moderation/flags/grouped")
+    assert response.status_code == 403
+
+# Moderation stats tests
+def test_moderation_stats_follow_moderation_actions(client):
+    login_session(client)
+    first = client.post('/api/comments', json={"article_id": "product_1", "content": "Spam"}).get_json()['_id']
+    second = client.post('/api/comments', json={"article_id": "product_1", "content": "Rude"}).get_json()['_id']
+    client.post(f"/api/comments/{first}/flag", json={"reason": "Spam"})
+    client.post(f"/api/comments/{second}/flag", json={"reason": "Abuse"})
+    client.post("/api/reviews/product_1_review_0/flag", json={"reason": "Spam"})
+
+    login_session(client, email="moderator@hw3.com")
+    stats = client.get("/api/moderation/stats").get_json()
+    assert stats["open_flags"] == {"total": 3, "by_type": {"comment": 2, "review": 1}, "by_reason": {"Spam": 2, "Abuse": 1}}
+
+    flag_id = next(flag['_id'] for flag in client.get("/api/moderation/flags").get_json()
+                   if flag.get('content_id') == first)
+    client.patch(f"/api/moderation/flags/{flag_id}/resolve", json={"action": "remove_content"})
+    client.patch(f"/api/moderation/flags/{flag_id}/resolve", json={"action": "remove_content"})
+    client.post("/api/moderation/flags/bulk-resolve", json={
+        "action": "remove_content", "content": [{"content_type": "review", "content_id": "product_1_review_0"}]
+    })
+    client.patch(f"/api/comments/{second}/redact", json={"redacted_content": "████"})
+    client.delete(f"/api/comments/{first}")
+
+    stats = client.get("/api/moderation/stats").get_json()
+    assert stats["open_flags"]["total"] == 1
+    assert stats["open_flags"]["by_reason"] == {"Spam": 0, "Abuse": 1}
+    assert stats["removed_comments"] == 1
+    assert stats["redacted_comments"] == 1
+    assert stats["hidden_reviews"] == 1
+    assert stats["resolutions"] == [{
+        "day": datetime.now(timezone.utc).strftime('%Y-%m-%d'),
+        "moderator": "moderator@hw3.com",
+        "count": 2,
+        "actions": {"remove_content": 2}
+    }]
+
+def test_reconcile_moderation_stats_repairs_drift(client):
+    login_session(client)
+    comment_id = client.post('/api/comments', json={"article_id": "product_1", "content": "Spam"}).get_json()['_id']
+    client.post(f"/api/comments/{comment_id}/flag", json={"reason": "spam.link"})
+    app_module.moderation_stats_collection.update_one({"_id": "totals"}, {"$set": {"open_flags.total": 42}})
+    app_module.flags_collection.insert_one({
+        "review_id": "product_2_review_0", "reason": "Spam", "resolved": True,
+        "resolved_at": datetime.now(timezone.utc), "resolved_by": "admin@hw3.com", "action_taken": "resolve_only"
+    })
+
+    assert app_module.reconcile_moderation_stats() == {"open_flags": 1, "resolution_rows": 1}
+    login_session(client, email="admin@hw3.com")
+    stats = client.get("/api/moderation/stats?days=1").get_json()
+    assert stats["open_flags"] == {"total": 1, "by_type": {"comment": 1}, "by_reason": {"spam_link": 1}}
+    assert stats["resolutions"][0]["moderator"] == "admin@hw3.com"
+    assert stats["reconciled_at"] is not None
+    assert client.get("/api/moderation/stats?days=0").status_code == 400
+
+    result = app.test_cli_runner().invoke(args=["reconcile-moderation-stats"])
+    assert "'open_flags': 1" in result.output
+
+# Bulk resolve tests
+def test_bulk_resolve_remove_closes_sibling_flags(client):
+    login_session(client)
+    comment_id = client.post('/api/comments', json={
+        "article_id": "test-article",
+        "content": "Brigaded comment"
+    }).get_json()['_id']
+    for i in range(3):
+        login_session(client, email=f"user{i}@hw3.com")
+        client.post(f"/api/comments/{comment_id}/flag", json={"reason": "Spam"})
+        client.post("/api/reviews/product_1_review_0/flag", json={"reason": "Spam"})
+
+    login_session(client, email="moderator@hw3.com")
+    flags = client.get("/api/moderation/flags").get_json()
+    flag_id = next(flag['_id'] for flag in flags if flag.get('content_type') == 'comment')
+    response = client.post("/api/moderation/flags/bulk-resolve", json={
+        "action": "remove_content",
+        "flag_ids": [flag_id],
+        "content": [{"content_type": "review", "content_id": "product_1_review_0"}]
+    })
+    assert response.status_code == 200
+    data = response.get_json()
+    assert data["flags_resolved"] == 6
+    assert all(result["flags_resolved"] == 3 for result in data["results"])
+    assert all(result["content_updated"] for result in data["results"])
+    assert client.get("/api/moderation/flags").get_json() == []
+
+    comments = client.get('/api/comments?article_id=test-article').get_json()
+    assert comments[0]['is_removed'] is True
+
+def test_bulk_resolve_redact_content(client):
+    login_session(client)
+    comment_id = client.post('/api/comments', json={
+        "article_id": "test-article",
+        "content": "Secret 1234"
+    }).get_json()['_id']
+    client.post(f"/api/comments/{comment_id}/flag", json={"reason": "Sensitive data"})
+
+    login_session(client, email="admin@hw3.com")
+    response = client.post("/api/moderation/flags/bulk-resolve", json={
+        "action": "redact_content",
+        "redacted_content": "Secret ████",
+        "content": [{"content_type": "comment", "content_id": comment_id}]
+    })
+    assert response.status_code == 200
+    comments = client.get('/api/comments?article_id=test-article').get_json()
+    assert comments[0]['redacted_content'] == "Secret ████"
+
+def test_bulk_resolve_validation(client):
+    login_session(client, email="moderator@hw3.com")
+    response = client.post("/api/moderation/flags/bulk-resolve", json={"action": "delete_everything"})
+    assert response.status_code == 400
+    response = client.post("/api/moderation/flags/bulk-resolve", json={"action": "redact_content", "flag_ids": ["x"]})
+    assert response.status_code == 400
+    response = client.post("/api/moderation/flags/bulk-resolve", json={"action": "resolve_only"})
+    assert response.status_code == 400
+
+def test_bulk_resolve_unknown_flags(client):
+    login_session(client, email="moderator@hw3.com")
+    response = client.post("/api/moderation/flags/bulk-resolve", json={
+        "flag_ids": ["64dd7c8f2f00000000000000", "bad_id"]
+    })
+    assert response.status_code == 404
+    assert len(response.get_json()["unknown_flag_ids"]) == 2
+
+# Live event stream tests
+def read_stream(response, count):
+    chunks = response.response
+    events = [next(chunks) for _ in range(count)]
+    response.close()
+    return [chunk.decode() if isinstance(chunk, bytes) else chunk for chunk in events]
+
+def test_stream_replays_events_after_last_event_id(client):
+    login_session(client)
+    client.post('/api/comments', json={"article_id": "product_1", "content": "First"})
+    client.post('/api/comments', json={"article_id": "product_1", "content": "Second"})
+    client.post("/api/reviews/product_1_review_0/vote", json={"vote_type": "up"})
+
+    response = client.get("/api/stream/product_1", headers={"Last-Event-ID": "1"}, buffered=False)
+    assert response.status_code == 200
+    assert response.mimetype == "text/event-stream"
+    chunks = read_stream(response, 3)
+    assert chunks[0].startswith("retry:")
+    assert "id: 2\nevent: comment_created" in chunks[1]
+    assert '"Second"' in chunks[1]
+    assert "event: review_votes" in chunks[2]
+    data = json.loads(chunks[2].split("data: ", 1)[1])
+    assert data["votes"]["upvotes"] == 1
+
+def test_stream_pushes_live_events_and_heartbeats(client, monkeypatch):
+    monkeypatch.setattr("app.STREAM_HEARTBEAT_SECONDS", 0.01)
+    response = client.get("/api/stream/test-article", buffered=False)
+    chunks = response.response
+    next(chunks)
+    assert next(chunks).decode() == ": heartbeat\n\n"
+
+    login_session(client, email="moderator@hw3.com")
+    comment_id = client.post('/api/comments', json={"article_id": "test-article", "content": "Live"}).get_json()['_id']
+    client.delete(f"/api/comments/{comment_id}")
+    received = ''
+    while "comment_removed" not in received:
+        received += next(chunks).decode()
+    response.close()
+    assert "comment_created" in received
+    assert app_module.event_broker.has_subscribers("test-article") is False
+
+def test_resolve_flag_events_recorded_without_listeners(client):
+    login_session(client)
+    comment_id = client.post('/api/comments', json={"article_id": "product_1", "content": "Spam"}).get_json()['_id']
+    client.post(f"/api/comments/{comment_id}/flag", json={"reason": "Spam"})
+
+    login_session(client, email="moderator@hw3.com")
+    flag_id = client.get("/api/moderation/flags").get_json()[0]['_id']
+    response = client.patch(f"/api/moderation/flags/{flag_id}/resolve", json={"action": "remove_content"})
+    assert response.status_code == 200
+
+    events = [event["event"] for event in app_module.event_broker.history["product_1"]]
+    assert events == ["comment_created", "comment_removed"]
+
+def test_event_broker_drops_overflowing_subscriber():
+    broker = app_module.EventBroker(replay_size=2, subscriber_size=1)
+    subscriber, _ = broker.subscribe("a")
+    broker.publish("a", "comment_created", {})
+    broker.publish("a", "comment_created", {})
+    assert subscriber.overflowed is True
+    assert broker.has_subscribers("a") is False
+    _, replay = broker.subscribe("a", last_event_id=0)
+    assert [event["id"] for event in replay] == [1, 2]
+    broker.publish("a", "comment_created", {})
+    _, replay = broker.subscribe("a", last_event_id=0)
+    assert [event["id"] for event in replay] == [2, 3]
+
+def test_stream_invalid_last_event_id(client):
+    response = client.get("/api/stream/test-article?last_event_id=abc")
+    assert response.status_code == 400
+
+# Write-behind vote buffer tests
+@pytest.fixture
+def buffered_votes(monkeypatch):
+    buffer = app_module.VoteBuffer(enabled=True, flush_interval=None, max_pending=100)
+    monkeypatch.setattr("app.vote_buffer", buffer)
+    return buffer
+
+def test_buffered_votes_coalesce_and_flush(client, buffered_votes):
+    login_session(client)
+    for vote_type in ["up", "down", "up"]:
+        response = client.post("/api/reviews/product_1_review_0/vote", json={"vote_type": vote_type})
+    assert response.get_json()["action"] == "updated"
+    assert response.get_json()["votes"]["upvotes"] == 1
+    assert app_module.votes_collection.count_documents({}) == 0
+
+    # Read-your-writes before the flush
+    assert client.get("/api/reviews/product_1_review_0/user-vote").get_json()["vote_type"] == "up"
+
+    assert buffered_votes.flush() == 1
+    votes = list(app_module.votes_collection.find({}))
+    assert len(votes) == 1
+    assert votes[0]["vote_type"] == "up"
+    assert client.get("/api/reviews/product_1_review_0/votes").get_json()["upvotes"] == 1
+
+def test_buffered_vote_removal_deletes_on_flush(client, buffered_votes):
+    login_session(client)
+    comment_id = client.post('/api/comments', json={"article_id": "test-article", "content": "Hi"}).get_json()['_id']
+    app_module.votes_collection.insert_one({
+        "content_id": comment_id, "content_type": "comment",
+        "user_email": "user@hw3.com", "vote_type": "down"
+    })
+
+    response = client.post(f"/api/comments/{comment_id}/vote", json={"vote_type": "down"})
+    assert response.get_json()["action"] == "removed"
+    assert response.get_json()["votes"]["downvotes"] == 0
+    assert client.get(f"/api/comments/{comment_id}/user-vote").get_json()["vote_type"] is None
+
+    buffered_votes.flush()
+    assert app_module.votes_collection.count_documents({}) == 0
+
+def test_buffered_votes_flush_on_size(client, monkeypatch):
+    buffer = app_module.VoteBuffer(enabled=True, flush_interval=None, max_pending=2)
+    monkeypatch.setattr("app.vote_buffer", buffer)
+    login_session(client)
+    client.post("/api/reviews/product_1_review_0/vote", json={"vote_type": "up"})
+    assert app_module.votes_collection.count_documents({}) == 0
+    client.post("/api/reviews/product_1_review_1/vote", json={"vote_type": "up"})
+    assert app_module.votes_collection.count_documents({}) == 2
+    assert buffer.pending == {}
+
+def test_buffered_votes_kept_when_flush_fails(client, buffered_votes):
+    login_session(client)
+    client.post("/api/reviews/product_1_review_0/vote", json={"vote_type": "up"})
+    with patch("app.votes_collection.bulk_write", side_effect=Exception("DB down")):
+        with pytest.raises(Exception):
+            buffered_votes.flush()
+    assert len(buffered_votes.pending) == 1
+    buffered_votes.flush()
+    assert app_module.votes_collection.count_documents({"vote_type": "up"}) == 1
+
+def test_buffered_votes_visible_while_flush_in_flight(client, buffered_votes):
+    login_session(client)
+    client.post("/api/reviews/product_1_review_0/vote", json={"vote_type": "up"})
+    seen = {}
+    real_bulk_write = app_module.votes_collection.bulk_write
+
+    def slow_bulk_write(operations, ordered=True):
+        # Reads and toggles issued while the batch is being written
+        seen["votes"] = client.get("/api/reviews/product_1_review_0/votes").get_json()["upvotes"]
+        seen["user_vote"] = client.get("/api/reviews/product_1_review_0/user-vote").get_json()["vote_type"]
+        seen["action"] = client.post("/api/reviews/product_1_review_0/vote", json={"vote_type": "up"}).get_json()["action"]
+        return real_bulk_write(operations, ordered=ordered)
+
+    with patch("app.votes_collection.bulk_write", side_effect=slow_bulk_write):
+        buffered_votes.flush()
+    assert seen == {"votes": 1, "user_vote": "up", "action": "removed"}
+    assert buffered_votes.in_flight == {}
+    assert client.get("/api/reviews/product_1_review_0/votes").get_json()["upvotes"] == 0
+    buffered_votes.flush()
+    assert app_module.votes_collection.count_documents({}) == 0
+
+def test_buffered_vote_succeeds_when_size_flush_fails(client, monkeypatch):
+    buffer = app_module.VoteBuffer(enabled=True, flush_interval=None, max_pending=1)
+    monkeypatch.setattr("app.vote_buffer", buffer)
+    login_session(client)
+    with patch("app.votes_collection.bulk_write", side_effect=Exception("DB down")):
+        response = client.post("/api/reviews/product_1_review_0/vote", json={"vote_type": "up"})
+    assert response.status_code == 200
+    assert response.get_json()["votes"]["upvotes"] == 1
+    assert len(buffer.pending) == 1
+    buffer.flush()
+    assert app_module.votes_collection.count_documents({}) == 1
+
+def test_vote_buffer_flushes_at_exit_without_interval(client, buffered_votes):
+    login_session(client)
+    with patch("app.atexit.register") as register:
+        client.post("/api/reviews/product_1_review_0/vote", json={"vote_type": "up"})
+        client.post("/api/reviews/product_1_review_1/vote", json={"vote_type": "up"})
+    register.assert_called_once_with(buffered_votes.flush)
+    buffered_votes.flush()
+
+# Ranking tests
+def test_wilson_lower_bound_prefers_confidence():
+    assert app_module.wilson_lower_bound(0, 0) == 0.0
+    assert app_module.wilson_lower_bound(100, 10) > app_module.wilson_lower_bound(1, 0)
+    assert app_module.controversy_score(10, 0) == 0.0
+    assert app_module.controversy_score(50, 50) > app_module.controversy_score(90, 10)
+
+@patch("app.requests.get")
+def test_get_product_by_id_sorted_by_ranking(mock_get, client):
+    mock_get.return_value.status_code = 200
+    mock_get.return_value.json.side_effect = lambda: {
+        "id": 1,
+        "reviews": [
+            {"comment": "Old", "date": "2024-01-01"},
+            {"comment": "Loved", "date": "2024-03-01"},
+            {"comment": "Split", "date": "2024-02-01"}
+        ]
+    }
+    for i in range(3):
+        login_session(client, email=f"user{i}@hw3.com")
+        client.post("/api/reviews/product_1_review_1/vote", json={"vote_type": "up"})
+        client.post("/api/reviews/product_1_review_2/vote", json={"vote_type": "up" if i % 2 else "down"})
+
+    top = client.get("/api/products/1?sort=top").get_json()["reviews"]
+    assert [review["comment"] for review in top] == ["Loved", "Split", "Old"]
+    controversial = client.get("/api/products/1?sort=controversial").get_json()["reviews"]
+    assert controversial[0]["comment"] == "Split"
+    new = client.get("/api/products/1?sort=new").get_json()["reviews"]
+    assert [review["comment"] for review in new] == ["Loved", "Split", "Old"]
+    assert client.get("/api/products/1?sort=random").status_code == 400
+
+def test_get_comments_sorted_by_ranking(client):
+    login_session(client)
+    first_id = client.post('/api/comments', json={"article_id": "product_1", "content": "First"}).get_json()['_id']
+    client.post('/api/comments', json={"article_id": "product_1", "content": "Second"})
+    client.post(f"/api/comments/{first_id}/vote", json={"vote_type": "up"})
+
+    comments = client.get("/api/comments?article_id=product_1&sort=top").get_json()
+    assert comments[0]["content"] == "First"
+    ranking = app_module.rankings_collection.find_one({"content_id": first_id})
+    assert ranking["article_id"] == "product_1"
+    assert ranking["upvotes"] == 1
+    assert client.get("/api/comments?article_id=product_1&sort=bad").status_code == 400
+
+def test_rebuild_rankings_backfills_existing_votes(client):
+    comment_id = str(app_module.comments_collection.insert_one({"article_id": "product_1", "content": "Old"}).inserted_id)
+    app_module.votes_collection.insert_many([
+        {"content_type": "comment", "content_id": comment_id, "user_email": "a@hw3.com", "vote_type": "up"},
+        {"content_type": "comment", "content_id": comment_id, "user_email": "b@hw3.com", "vote_type": "up"},
+        {"review_id": "product_1_review_2", "user_email": "a@hw3.com", "vote_type": "down"},
+        {"content_type": "comment", "content_id": str(ObjectId()), "user_email": "a@hw3.com", "vote_type": "up"}
+    ])
+    assert app_module.rebuild_rankings(batch_size=2) == 2
+
+    ranking = app_module.rankings_collection.find_one({"content_id": comment_id})
+    assert ranking["article_id"] == "product_1"
+    assert ranking["upvotes"] == 2
+    assert ranking["wilson_score"] > 0
+    review = app_module.rankings_collection.find_one({"content_id": "product_1_review_2"})
+    assert review["content_type"] == "review"
+    assert review["score"] == -1
+
+    result = app.test_cli_runner().invoke(args=["rebuild-rankings"])
+    assert "Rebuilt 2 rankings" in result.output
+
+# Product listing field selection tests
+@patch("app.requests.get")
+def test_products_summary_view(mock_get, client):
+    mock_get.return_value.json.return_value = {
+        "products": [{
+            "id": 1,
+            "title": "iPhone",
+            "reviews": [{"rating": 5}, {"rating": 2}, {"rating": 4}]
+        }]
+    }
+    app_module.hidden_reviews_collection.insert_one({"review_id": "product_1_review_1"})
+    login_session(client)
+    client.post('/api/comments', json={"article_id": "product_1", "content": "Nice"})
+
+    with patch("app.get_review_votes") as mock_votes:
+        response = client.get("/api/products?view=summary")
+        mock_votes.assert_not_called()
+    product = response.get_json()["products"][0]
+    assert "reviews" not in product
+    assert product["review_count"] == 2
+    assert product["average_rating"] == 4.5
+    assert product["community_comments_count"] == 1
+    select = mock_get.call_args.kwargs['params']['select'].split(',')
+    assert 'thumbnail' in select and 'reviews' in select
+    assert 'review_count' not in select
+
+@patch("app.requests.get")
+def test_products_explicit_fields(mock_get, client):
+    mock_get.return_value.json.return_value = {"products": [{"id": 1, "title": "iPhone"}]}
+    response = client.get("/api/products/search?q=phone&fields=title,price")
+    assert mock_get.call_args.kwargs['params']['select'] == "title,price"
+    assert response.get_json()["products"][0] == {"id": 1, "title": "iPhone"}
+
+@patch("app.requests.get")
+def test_products_full_view_keeps_reviews(mock_get, client):
+    mock_get.return_value.json.return_value = {"products": [{"id": 1, "reviews": [{"rating": 5}]}]}
+    response = client.get("/api/products")
+    product = response.get_json()["products"][0]
+    assert product["reviews"][0]["votes"]["score"] == 0
+    assert product["review_count"] == 1
+    assert 'select' not in mock_get.call_args.kwargs['params']
+
+# Community-sorted product listing tests
+def upstream_product(url, params=None, timeout=None):
+    response = MagicMock(status_code=200)
+    response.json.return_value = {"id": int(url.rsplit('/', 1)[1]), "title": url, "reviews": []}
+    return response
+
+def test_engagement_counters_follow_comments_and_votes(client):
+    login_session(client)
+    comment_id = client.post('/api/comments', json={"article_id": "product_2", "content": "Hi"}).get_json()['_id']
+    client.post('/api/comments', json={"article_id": "test-article", "content": "Not a product"})
+    client.post(f"/api/comments/{comment_id}/vote", json={"vote_type": "up"})
+    client.post("/api/reviews/product_2_review_1/vote", json={"vote_type": "down"})
+    client.post("/api/reviews/product_2_review_1/vote", json={"vote_type": "up"})
+
+    engagement = app_module.engagement_collection.find_one({"article_id": "product_2"})
+    assert engagement["product_id"] == 2
+    assert engagement["comment_count"] == 1
+    assert engagement["vote_score"] == 2
+    assert engagement["trending_score"] > 0
+    assert app_module.engagement_collection.count_documents({}) == 1
+
+    client.post("/api/reviews/product_2_review_1/vote", json={"vote_type": "up"})
+    assert app_module.engagement_collection.find_one({"article_id": "product_2"})["vote_score"] == 1
+
+def test_trending_increment_decays_older_activity():
+    now = datetime.now(timezone.utc)
+    older = app_module.trending_increment(1, now - timedelta(hours=app_module.TRENDING_HALF_LIFE_HOURS))
+    assert app_module.trending_increment(1, now) == pytest.approx(2 * older)
+
+@patch("app.requests.get", side_effect=upstream_product)
+def test_products_sorted_by_community_engagement(mock_get, client):
+    login_session(client)
+    for _ in range(2):
+        client.post('/api/comments', json={"article_id": "product_3", "content": "Busy"})
+    client.post('/api/comments', json={"article_id": "product_1", "content": "Quiet"})
+    for i in range(2):
+        login_session(client, email=f"user{i}@hw3.com")
+        client.post("/api/reviews/product_1_review_1/vote", json={"vote_type": "up"})
+
+    products = client.get("/api/products?sort=most_comments").get_json()
+    assert [p["id"] for p in products["products"]] == [3, 1]
+    assert products["products"][0]["engagement"]["comment_count"] == 2
+    assert products["total"] == 2
+
+    top = client.get("/api/products?sort=top_voted&limit=1").get_json()
+    assert [p["id"] for p in top["products"]] == [1]
+    assert mock_get.call_args.args[0].endswith("/products/1")
+
+    assert client.get("/api/products?sort=trending").status_code == 200
+    assert client.get("/api/products?sort=popular").status_code == 400
+
+def test_rebuild_engagement_from_existing_data(client):
+    comment_id = app_module.comments_collection.insert_one({"article_id": "product_4", "content": "Old"}).inserted_id
+    app_module.votes_collection.insert_many([
+        {"content_type": "comment", "content_id": str(comment_id), "user_email": "a@hw3.com", "vote_type": "up"},
+        {"content_type": "review", "content_id": "product_4_review_1", "user_email": "a@hw3.com", "vote_type": "up"},
+        {"content_type": "review", "content_id": "product_4_review_1", "user_email": "b@hw3.com", "vote_type": "down"},
+        {"content_type": "review", "content_id": "product_5_review_1", "user_email": "b@hw3.com", "vote_type": "up"}
+    ])
+    assert app_module.rebuild_product_engagement() == 2
+    engagement = app_module.engagement_collection.find_one({"article_id": "product_4"})
+    assert engagement["comment_count"] == 1
+    assert engagement["vote_score"] == 1
+    assert app_module.engagement_collection.find_one({"article_id": "product_5"})["vote_score"] == 1
+
+    result = app.test_cli_runner().invoke(args=["rebuild-engagement"])
+    assert "Rebuilt engagement for 2 products" in result.output
+
+# Product bundle tests
+def bundle_upstream(url, params=None, timeout=None):
+    response = MagicMock(status_code=200)
+    response.json.return_value = {
+        "id": 1,
+        "reviews": [{"comment": "Great", "date": "2024-01-01"}, {"comment": "Hidden"}, {"comment": "Fine", "date": "2024-02-01"}]
+    }
+    return response
+
+@patch("app.requests.get", side_effect=bundle_upstream)
+def test_product_bundle_returns_page_data(mock_get, client):
+    login_session(client, email="other@hw3.com")
+    client.post("/api/reviews/product_1_review_0/vote", json={"vote_type": "up"})
+    login_session(client)
+    comment_id = client.post('/api/comments', json={"article_id": "product_1", "content": "Hi"}).get_json()['_id']
+    client.post(f"/api/comments/{comment_id}/vote", json={"vote_type": "up"})
+    client.post("/api/reviews/product_1_review_2/vote", json={"vote_type": "down"})
+    app_module.hidden_reviews_collection.insert_one({"review_id": "product_1_review_1"})
+
+    bundle = client.get("/api/products/1/bundle?sort=top").get_json()
+    reviews = bundle["product"]["reviews"]
+    assert [review["id"] for review in reviews] == ["product_1_review_0", "product_1_review_2"]
+    assert reviews[0]["votes"]["upvotes"] == 1
+    assert reviews[1]["votes"]["score"] == -1
+    assert bundle["comments"][0]["votes"]["upvotes"] == 1
+    assert bundle["has_more_comments"] is False
+    assert bundle["user_votes"] == {
+        "reviews": {"product_1_review_2": "down"},
+        "comments": {comment_id: "up"}
+    }
+    assert mock_get.call_count == 1
+
+@patch("app.requests.get", side_effect=bundle_upstream)
+def test_product_bundle_anonymous_and_paged(mock_get, client):
+    login_session(client)
+    for i in range(3):
+        client.post('/api/comments', json={"article_id": "product_1", "content": f"Comment {i}"})
+    with client.session_transaction() as sess:
+        sess.clear()
+    bundle = client.get("/api/products/1/bundle?comment_limit=2").get_json()
+    assert len(bundle["comments"]) == 2
+    assert bundle["has_more_comments"] is True
+    assert bundle["user_votes"] == {}
+    assert client.get("/api/products/1/bundle?comment_limit=0").status_code == 400
+    assert client.get("/api/products/1/bundle?sort=bad").status_code == 400
+
+@patch("app.requests.get")
+def test_product_bundle_not_found(mock_get, client):
+    mock_get.return_value.status_code = 404
+    assert client.get("/api/products/999/bundle").status_code == 404
+
+def test_product_bundle_runs_dependencies_concurrently(client):
+    def slow_upstream(url, params=None, timeout=None):
+        time.sleep(0.3)
+        return bundle_upstream(url)
+
+    def slow_comments(article_id, limit, user_email):
+        time.sleep(0.3)
+        return [], False, {}
+
+    with patch("app.requests.get", side_effect=slow_upstream), patch("app.load_comment_page", side_effect=slow_comments):
+        started = time.monotonic()
+        assert client.get("/api/products/1/bundle").status_code == 200
+        assert time.monotonic() - started < 0.55
+
+# Product multi-get tests
+def batch_upstream(url, params=None, timeout=None):
+    product_id = int(url.rsplit('/', 1)[1])
+    response = MagicMock(status_code=404 if product_id == 404 else 200)
+    response.json.return_value = {"id": product_id, "title": f"Product {product_id}", "reviews": [{"rating": 4}]}
+    return response
+
+@patch("app.requests.get", side_effect=batch_upstream)
+def test_products_batch_fetches_and_caches(mock_get, client):
+    login_session(client)
+    client.post("/api/reviews/product_2_review_0/vote", json={"vote_type": "up"})
+
+    data = client.get("/api/products/batch?ids=2,1,404,2").get_json()
+    assert [product["id"] for product in data["products"]] == [2, 1]
+    assert data["missing"] == [404]
+    assert data["products"][0]["reviews"][0]["votes"]["upvotes"] == 1
+    assert mock_get.call_count == 3
+
+    mock_get.reset_mock()
+    data = client.get("/api/products/batch?ids=1,2&fields=title,review_count").get_json()
+    mock_get.assert_not_called()
+    assert data["products"][0] == {"id": 1, "title": "Product 1", "review_count": 1}
+
+@patch("app.requests.get", side_effect=batch_upstream)
+def test_products_batch_decorates_once(mock_get, client):
+    with patch("app.stored_vote_counts", wraps=app_module.stored_vote_counts) as counts, \
+            patch("app.get_hidden_review_ids", wraps=app_module.get_hidden_review_ids) as hidden:
+        client.get("/api/products/batch?ids=1,2,3")
+    assert counts.call_count == 1
+    assert hidden.call_count == 1
+
+def test_products_batch_validation(client):
+    assert client.get("/api/products/batch").status_code == 400
+    assert client.get("/api/products/batch?ids=1,abc").status_code == 400
+    ids = ",".join(str(i) for i in range(app_module.PRODUCT_BATCH_MAX_IDS + 1))
+    assert client.get(f"/api/products/batch?ids={ids}").status_code == 400
+
+def test_export_comments_ndjson_with_resume(client):
+    login_session(client)
+    for content in ["One", "Two", "Three"]:
+        client.post('/api/comments', json={"article_id": "product_1", "content": content})
+    client.post('/api/comments', json={"article_id": "product_2", "content": "Other"})
+
+    login_session(client, email="moderator@hw3.com")
+    response = client.get("/api/moderation/export/comments?article_id=product_1")
+    assert response.status_code == 200
+    assert response.mimetype == "application/x-ndjson"
+    rows = [json.loads(line) for line in response.data.decode().splitlines()]
+    assert [row["content"] for row in rows] == ["One", "Two", "Three"]
+
+    response = client.get(f"/api/moderation/export/comments?article_id=product_1&after={rows[0]['_id']}")
+    rows = [json.loads(line) for line in response.data.decode().splitlines()]
+    assert [row["content"] for row in rows] == ["Two", "Three"]
+
+def test_export_flags_csv_filtered_by_resolved(client):
+    login_session(client)
+    client.post("/api/reviews/product_1_review_0/flag", json={"reason": "Spam"})
+    client.post("/api/reviews/product_2_review_0/flag", json={"reason": "Rude"})
+    app_module.flags_collection.update_one({"review_id": "product_2_review_0"}, {"$set": {"resolved": True}})
+
+    login_session(client, email="moderator@hw3.com")
+    response = client.get("/api/moderation/export/flags?format=csv&resolved=false&article_id=product_1")
+    assert response.mimetype == "text/csv"
+    lines = response.data.decode().splitlines()
+    assert lines[0].startswith("_id,review_id")
+    assert len(lines) == 2
+    assert "Spam" in lines[1]
+
+def test_export_votes_date_range(client):
+    login_session(client)
+    client.post("/api/reviews/product_1_review_0/vote", json={"vote_type": "up"})
+    login_session(client, email="moderator@hw3.com")
+    response = client.get("/api/moderation/export/votes?from=2000-01-01T00:00:00&to=2001-01-01T00:00:00")
+    assert response.data == b""
+    response = client.get("/api/moderation/export/votes?from=2000-01-01T00:00:00")
+    assert json.loads(response.data)["vote_type"] == "up"
+
+def test_export_article_includes_comment_content(client):
+    login_session(client)
+    comment_id = client.post('/api/comments', json={"article_id": "product_1", "content": "Hi"}).get_json()['_id']
+    other_id = client.post('/api/comments', json={"article_id": "product_2", "content": "Other"}).get_json()['_id']
+    for content_id in (comment_id, other_id):
+        client.post(f"/api/comments/{content_id}/vote", json={"vote_type": "up"})
+        client.post(f"/api/comments/{content_id}/flag", json={"reason": "Spam"})
+    client.post("/api/reviews/product_1_review_0/vote", json={"vote_type": "down"})
+    client.post("/api/reviews/product_1_review_0/flag", json={"reason": "Spam"})
+
+    login_session(client, email="moderator@hw3.com")
+    for name in ("votes", "flags"):
+        response = client.get(f"/api/moderation/export/{name}?article_id=product_1")
+        rows = [json.loads(line) for line in response.data.decode().splitlines()]
+        assert len(rows) == 2
+        assert other_id not in response.data.decode()
+
+def test_export_validation(client):
+    login_session(client, email="moderator@hw3.com")
+    assert client.get("/api/moderation/export/users").status_code == 404
+    assert client.get("/api/moderation/export/votes?format=xml").status_code == 400
+    assert client.get("/api/moderation/export/votes?from=yesterday").status_code == 400
+    assert client.get("/api/moderation/export/flags?resolved=maybe").status_code == 400
+    login_session(client)
+    assert client.get("/api/moderation/export/votes").status_code == 403
+
+# Archival tests
+def test_archive_and_restore_removed_comment(client):
+    login_session(client, email="moderator@hw3.com")
+    old_id = client.post('/api/comments', json={"article_id": "product_1", "content": "Old spam"}).get_json()['_id']
+    new_id = client.post('/api/comments', json={"article_id": "product_1", "content": "New spam"}).get_json()['_id']
+    client.post(f"/api/comments/{old_id}/vote", json={"vote_type": "up"})
+    client.delete(f"/api/comments/{old_id}")
+    client.delete(f"/api/comments/{new_id}")
+    app_module.comments_collection.update_one(
+        {"_id": ObjectId(old_id)},
+        {"$set": {"removed_at": datetime.now(timezone.utc) - timedelta(days=60)}}
+    )
+
+    response = client.post("/api/moderation/archive/run", json={})
+    assert response.status_code == 200
+    assert response.get_json()["archived"] == {"flags": 0, "comments": 1, "votes": 1}
+    remaining = client.get("/api/comments?article_id=product_1").get_json()
+    assert [comment["_id"] for comment in remaining] == [new_id]
+    assert app_module.comments_archive_collection.find_one({"_id": ObjectId(old_id)})["archived_at"]
+
+    response = client.post("/api/moderation/archive/restore", json={"collection": "comments", "ids": [old_id]})
+    assert response.get_json()["restored"] == {"comments": 1, "votes": 1}
+    restored = app_module.comments_collection.find_one({"_id": ObjectId(old_id)})
+    assert "archived_at" not in restored
+    assert app_module.votes_collection.count_documents({"content_id": old_id}) == 1
+
+def test_archive_resolved_flags_in_batches(client):
+    old = datetime.now(timezone.utc) - timedelta(days=90)
+    app_module.flags_collection.insert_many(
+        [{"review_id": f"product_1_review_{i}", "resolved": True, "resolved_at": old} for i in range(5)] +
+        [{"review_id": "product_2_review_0", "resolved": False, "created_at": old}]
+    )
+    moved = app_module.run_archival(flags_after_days=30, comments_after_days=30, batch_size=2)
+    assert moved["flags"] == 5
+    assert app_module.flags_collection.count_documents({}) == 1
+    assert app_module.flags_archive_collection.count_documents({}) == 5
+
+def test_archive_restore_validation(client):
+    login_session(client, email="moderator@hw3.com")
+    assert client.post("/api/moderation/archive/restore", json={"collection": "votes", "ids": ["x"]}).status_code == 400
+    assert client.post("/api/moderation/archive/restore", json={"collection": "flags"}).status_code == 400
+    login_session(client)
+    assert client.post("/api/moderation/archive/run", json={}).status_code == 403
+
+def test_archive_ttl_follows_setting_changes(client, monkeypatch):
+    archive = app_module.flags_archive_collection
+    monkeypatch.setattr("app.ARCHIVE_TTL_DAYS", 1)
+    app_module.sync_archive_ttl(archive)
+    assert archive.index_information()["archived_at_1"]["expireAfterSeconds"] == 86400
+
+    monkeypatch.setattr("app.ARCHIVE_TTL_DAYS", 0)
+    app_module.sync_archive_ttl(archive)
+    assert "expireAfterSeconds" not in archive.index_information()["archived_at_1"]
+
+    monkeypatch.setattr("app.ARCHIVE_TTL_DAYS", 2)
+    app_module.sync_archive_ttl(archive)
+    assert archive.index_information()["archived_at_1"]["expireAfterSeconds"] == 172800
+
+    changed = MagicMock()
+    changed.name = "flags_archive"
+    changed.index_information.return_value = {
+        "archived_at_1": {"key": [("archived_at", 1)], "expireAfterSeconds": 86400}
+    }
+    app_module.sync_archive_ttl(changed)
+    changed.database.command.assert_called_once_with(
+        'collMod', "flags_archive", index={"keyPattern": {"archived_at": 1}, "expireAfterSeconds": 172800}
+    )
+    changed.drop_index.assert_not_called()
+
+def test_ensure_indexes_continues_after_a_failure(client):
+    with patch.object(app_module.flags_collection, "create_index", side_effect=Exception("conflict")):
+        app_module.ensure_indexes()
+    assert "content_type_1_content_id_1_vote_type_1" in app_module.votes_collection.index_information()
+    assert "archived_at_1" in app_module.votes_archive_collection.index_information()
+
+# JSON provider tests
+def test_json_provider_encodes_bson_types(client):
+    naive = datetime(2024, 1, 2, 3, 4, 5)
+    payload = {"_id": ObjectId("64dd7c8f2f00000000000000"), "created_at": naive}
+    encoded = json.loads(app.json.dumps(payload))
+    assert encoded["_id"] == "64dd7c8f2f00000000000000"
+    assert encoded["created_at"].startswith("2024-01-02T03:04:05")
+    assert encoded["created_at"].endswith("+00:00")
+
+def test_json_provider_stdlib_fallback(monkeypatch):
+    monkeypatch.setattr("app.orjson", None)
+    encoded = json.loads(app.json.dumps({"_id": ObjectId("64dd7c8f2f00000000000000"), "tags": {"a"}}))
+    assert encoded == {"_id": "64dd7c8f2f00000000000000", "tags": ["a"]}
+    with app.app_context():
+        response = app.json.response({"when": datetime(2024, 1, 2, tzinfo=timezone.utc)})
+    assert response.get_json()["when"] == "2024-01-02T00:00:00+00:00"
+
+def test_get_comments_returns_string_ids_without_conversion(client):
+    login_session(client)
+    comment_id = client.post('/api/comments', json={"article_id": "test-article", "content": "Hi"}).get_json()['_id']
+    comments = client.get('/api/comments?article_id=test-article').get_json()
+    assert comments[0]["_id"] == comment_id
+    assert "T" in comments[0]["created_at"]
+
+# Unified vote engine tests
+def test_votes_use_content_schema(client):
+    login_session(client)
+    client.post("/api/reviews/product_1_review_0/vote", json={"vote_type": "up"})
+    vote = app_module.votes_collection.find_one({})
+    assert vote["content_type"] == "review"
+    assert vote["content_id"] == "product_1_review_0"
+    assert "review_id" not in vote
+
+def test_legacy_review_votes_read_and_migrated(client):
+    app_module.votes_collection.insert_many([
+        {"review_id": "product_1_review_0", "user_email": "user@hw3.com", "vote_type": "up"},
+        {"review_id": "product_1_review_0", "user_email": "other@hw3.com", "vote_type": "down"}
+    ])
+    with patch("app.threading.Thread"):
+        login_session(client)
+        # Dual reads while the migration has not finished
+        assert client.get("/api/reviews/product_1_review_0/votes").get_json()["upvotes"] == 1
+        assert client.get("/api/reviews/product_1_review_0/user-vote").get_json()["vote_type"] == "up"
+        response = client.post("/api/reviews/product_1_review_0/vote", json={"vote_type": "down"})
+        assert response.get_json()["action"] == "updated"
+        assert response.get_json()["votes"]["downvotes"] == 2
+    assert app_module.review_votes_migrated is False
+
+    assert app_module.migrate_review_votes(batch_size=1) == 1
+    assert app_module.review_votes_migrated is True
+    assert app_module.votes_collection.count_documents({"review_id": {"$exists": True}}) == 0
+    assert client.get("/api/reviews/product_1_review_0/votes").get_json()["downvotes"] == 2
+
+def test_migration_skipped_without_legacy_votes(client):
+    client.get("/api/auth/status")
+    assert app_module.review_votes_migrated is True
+
+# OIDC client tests
+@patch("app.oauth.create_client")
+def test_oauth_client_built_once_with_fresh_nonces(mock_client, client):
+    mock_instance = MagicMock()
+    mock_client.return_value = mock_instance
+    mock_instance.authorize_redirect.return_value = "redirected"
+
+    nonces = []
+    for path in ["/login", "/api/auth/login"]:
+        client.get(path)
+        with client.session_transaction() as sess:
+            nonces.append(sess['nonce'])
+        assert mock_instance.authorize_redirect.call_args.kwargs['nonce'] == nonces[-1]
+    assert mock_client.call_count == 1
+    assert nonces[0] != nonces[1]
+
+@patch("app.oauth.create_client")
+def test_authorize_consumes_session_nonce(mock_client, client):
+    mock_instance = MagicMock()
+    mock_client.return_value = mock_instance
+    mock_instance.parse_id_token.return_value = {"email": "user@hw3.com"}
+    with client.session_transaction() as sess:
+        sess['nonce'] = "login-nonce"
+
+    client.get("/authorize")
+    assert mock_instance.parse_id_token.call_args.kwargs['nonce'] == "login-nonce"
+    with client.session_transaction() as sess:
+        assert 'nonce' not in sess
+
+def test_jwks_cache_ttl_and_throttled_refresh(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr("app.time.monotonic", lambda: clock[0])
+    fetch = MagicMock(side_effect=[{"keys": [1]}, {"keys": [2]}, {"keys": [3]}])
+    cache = app_module.JWKSCache(fetch, ttl=3600, min_refresh=30)
+
+    assert cache.fetch() == {"keys": [1]}
+    assert cache.fetch() == {"keys": [1]}
+    # Unknown kid right after a fetch does not hit the identity provider again
+    assert cache.fetch(force=True) == {"keys": [1]}
+    clock[0] += 31
+    assert cache.fetch(force=True) == {"keys": [2]}
+    clock[0] += 3600
+    assert cache.fetch() == {"keys": [3]}
+    assert fetch.call_count == 3
+
+# Upstream circuit breaker tests
+def test_circuit_breaker_opens_and_half_open_probe(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr("app.time.monotonic", lambda: clock[0])
+    breaker = app_module.CircuitBreaker(failure_rate_threshold=0.5, min_calls=4, window_size=4, open_seconds=30)
+    for failed in [False, True, False, True]:
+        assert breaker.allow_request()
+        breaker.record(failed)
+    assert breaker.state == 'open'
+    assert breaker.allow_request() is False
+
+    clock[0] += 31
+    assert breaker.allow_request() is True   # single probe
+    assert breaker.allow_request() is False
+    breaker.record(False, 0.1)
+    assert breaker.state == 'closed'
+
+def test_circuit_breaker_counts_slow_calls():
+    breaker = app_module.CircuitBreaker(min_calls=2, window_size=2, slow_call_seconds=1)
+    breaker.record(False, 5)
+    breaker.record(False, 5)
+    assert breaker.state == 'open'
+    assert breaker.snapshot()["slow_calls"] == 2
+
+@patch("app.requests.get")
+def test_products_served_stale_when_circuit_open(mock_get, client):
+    payload = {"products": [{"id": 1, "title": "iPhone", "reviews": []}]}
+    mock_get.return_value.json.side_effect = lambda: json.loads(json.dumps(payload))
+    mock_get.return_value.content = json.dumps(payload).encode()
+    assert client.get("/api/products").status_code == 200
+
+    app_module.upstream_breaker.trip()
+    mock_get.reset_mock()
+    response = client.get("/api/products")
+    assert response.status_code == 200
+    assert response.headers["X-Upstream-Stale"] == "true"
+    assert response.get_json()["products"][0]["title"] == "iPhone"
+    mock_get.assert_not_called()
+
+    # Nothing cached for this query: fail fast
+    response = client.get("/api/products?skip=20")
+    assert response.status_code == 503
+    assert int(response.headers["Retry-After"]) >= 1
+
+    metrics = client.get("/api/metrics/upstream").get_json()
+    assert metrics["state"] == "open"
+    assert metrics["stale_served"] == 1
+    assert metrics["rejected"] == 2
+
+@patch("app.requests.get")
+def test_product_served_stale_on_upstream_error(mock_get, client):
+    mock_get.return_value.status_code = 200
+    mock_get.return_value.json.side_effect = lambda: {"id": 1, "reviews": [{"rating": 5}]}
+    mock_get.return_value.content = b'{"id": 1, "reviews": [{"rating": 5}]}'
+    client.get("/api/products/1")
+
+    mock_get.side_effect = Exception("timeout")
+    response = client.get("/api/products/1")
+    assert response.status_code == 200
+    assert response.headers["X-Upstream-Stale"] == "true"
+    assert response.get_json()["reviews"][0]["votes"]["upvotes"] == 0
+
+@patch("app.requests.get")
+def test_upstream_client_errors_pass_through_without_tripping(mock_get, client):
+    response = app_module.requests.Response()
+    response.status_code = 400
+    response._content = b'{"message": "Invalid limit"}'
+    mock_get.return_value = response
+    for _ in range(app_module.upstream_breaker.min_calls + 5):
+        result = client.get("/api/products?limit=abc")
+        assert result.status_code == 400
+        assert result.get_json() == {"message": "Invalid limit"}
+    assert app_module.upstream_breaker.snapshot()["state"] == "closed"
+
+    response.status_code = 503
+    app_module.upstream_breaker.outcomes.clear()
+    for _ in range(app_module.upstream_breaker.min_calls):
+        assert client.get("/api/products?limit=abc").status_code == 500
+    assert app_module.upstream_breaker.snapshot()["state"] == "open"
+
+# Slow query profiler tests
+def command_events(request_id, command_name, command, duration_ms):
+    started = MagicMock(request_id=request_id, command_name=command_name, command=command)
+    finished = MagicMock(request_id=request_id, command_name=command_name, duration_micros=duration_ms * 1000)
+    return started, finished
+
+def test_query_shape_normalizes_values():
+    shape = app_module.query_shape({"article_id": "product_1", "_id": {"$in": [ObjectId(), ObjectId()]}})
+    assert shape == {"article_id": "?", "_id": {"$in": "?"}}
+
+def test_profiler_groups_slow_queries_by_shape(client):
+    profiler = app_module.query_profiler
+    profiler.threshold_ms = 50
+    profiler.explain_sample_rate = 0
+    for i, (article, duration) in enumerate([("a", 80), ("b", 120), ("c", 10)]):
+        started, finished = command_events(i, "find", {"find": "comments", "filter": {"article_id": article}}, duration)
+        with app.test_request_context("/api/comments"):
+            profiler.started(started)
+        profiler.succeeded(finished)
+
+    login_session(client, email="moderator@hw3.com")
+    queries = client.get("/api/moderation/slow-queries").get_json()["queries"]
+    assert len(queries) == 1
+    assert queries[0]["collection"] == "comments"
+    assert queries[0]["shape"] == {"article_id": "?"}
+    assert queries[0]["count"] == 2
+    assert queries[0]["max_ms"] == 120
+    assert queries[0]["routes"] == {"get_comments": 2}
+
+def test_profiler_explain_flags_collscan():
+    profiler = app_module.QueryProfiler(threshold_ms=0, explain_sample_rate=1)
+    profiler.database = MagicMock()
+    profiler.database.command.return_value = {
+        "queryPlanner": {"winningPlan": {"stage": "SORT", "inputStage": {"stage": "COLLSCAN"}}}
+    }
+    profiler.start = MagicMock()
+    started, finished = command_events(1, "find", {"find": "flags", "filter": {"resolved": False}, "lsid": {}}, 5)
+    profiler.started(started)
+    profiler.succeeded(finished)
+
+    key, command = profiler.explain_queue.get_nowait()
+    assert "lsid" not in command
+    profiler.explain(key, command)
+    report = profiler.report()
+    assert report[0]["collscan"] is True
+    assert report[0]["plan"] == ["SORT", "COLLSCAN"]
+
+def test_slow_queries_requires_moderator(client):
+    login_session(client)
+    assert client.get("/api/moderation/slow-queries").status_code == 403
+
+def test_slow_queries_invalid_limit(client):
+    login_session(client, email="moderator@hw3.com")
+    assert client.get("/api/moderation/slow-queries?limit=abc").status_code == 400
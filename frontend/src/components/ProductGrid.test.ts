@@ -1,4 +1,4 @@
-import { render, screen } from '@testing-library/svelte';
+import { render, screen, fireEvent } from '@testing-library/svelte';
 import { describe, it, expect, vi, beforeEach } from 'vitest';
 import ProductGrid from './ProductGrid.svelte';
 import * as store from '../lib/store';
@@ -26,5 +26,15 @@ describe('ProductGrid', () => {
       expect(await screen.findByText('Test Product 1')).toBeInTheDocument();
       expect(await screen.findByText('Test Product 2')).toBeInTheDocument();
     });
+
+    it('loads the full product when opening the detail page', async () => {
+      const fetchProductById = vi.spyOn(store, 'fetchProductById').mockResolvedValue({ id: 1, reviews: [] });
+      render(ProductGrid, { props: { products: [] } });
+
+      const buttons = await screen.findAllByText(/View Details & Reviews/);
+      await fireEvent.click(buttons[0]);
+
+      expect(fetchProductById).toHaveBeenCalledWith('1');
+    });
   });
 });
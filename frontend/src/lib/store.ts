@@ -57,7 +57,7 @@ export const checkAuthStatus = async (): Promise<void> => {
 // Fetch products from DummyJSON API
 export const fetchProducts = async (): Promise<void> => {
     try {
-        const response = await fetch('/api/products?limit=30');
+        const response = await fetch('/api/products?limit=30&view=summary');
         const data = await response.json();
         
         if (data.products && data.products.length > 0) {
@@ -73,7 +73,7 @@ export const fetchProducts = async (): Promise<void> => {
 // Search products by query
 export const searchProducts = async (query: string): Promise<void> => {
     try {
-        const response = await fetch(`/api/products/search?q=${encodeURIComponent(query)}`);
+        const response = await fetch(`/api/products/search?q=${encodeURIComponent(query)}&view=summary`);
         const data = await response.json();
         
         if (data.products) {